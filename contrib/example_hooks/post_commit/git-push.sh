@@ -4,6 +4,9 @@
 # commit to the local filesystem it commits with the description and detail (if they exist) and then
 # pushes.
 #
+# Setting `tt config --storage-layout lines` puts each record on a line of its own, so that each commit
+# only changes the lines of the records that changed.
+#
 # Depends on: git, jq, tr
 
 set -e
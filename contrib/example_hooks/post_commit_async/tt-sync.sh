@@ -0,0 +1,17 @@
+#!/bin/bash
+
+# Replicates the ledger after every commit by exchanging changes with the other replicas through a
+# shared directory (such as a synced or network folder), given by TT_SYNC_DIR, or the directory
+# ~/litt-sync by default. Unlike the git hooks, only the records and aliases that changed are
+# exchanged, and replicas that both changed a record never conflict.
+#
+# This is an asynchronous hook so that a slow shared directory doesn't hold up the command that
+# triggered it. Pair it with a periodic `tt sync` (such as from cron) to pick up the
+# changes made on other devices while nothing is committed on this one.
+#
+# Depends on: tt
+
+set -e
+
+cat - > /dev/null
+tt sync --dir "${TT_SYNC_DIR:-$HOME/litt-sync}" > /dev/null
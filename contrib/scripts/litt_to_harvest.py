@@ -1,16 +1,51 @@
 #!/usr/bin/env python3
+"""
+Sync the records in a litt ledger to Harvest time entries.
+
+The ledger is read from stdin, or from ~/.litt/events.json if stdin is a terminal. Only records
+changed since the last sync, according to the ledger's change log (`tt changes`), or that failed to
+sync last time, are considered; records that already have a Harvest entry are updated in place, and
+the rest are created. The Harvest entry ID, and the tags of the alias the record was matched to, are
+then written back to each record with `tt amend`, all in a single `tt exec` script.
+"""
 
 import json
 import sys
 import os
+import shlex
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import requests
 import time
 
 HARVEST_PERSONAL_ACCESS_TOKEN = os.environ["HARVEST_PERSONAL_ACCESS_TOKEN"]
 HARVEST_ACCOUNT_ID = os.environ["HARVEST_ACCOUNT_ID"]
+# Overridable to point the script at a local stub server for testing.
+HARVEST_API_URL = os.environ.get("HARVEST_API_URL",
+                                 "https://api.harvestapp.com/api/v2")
+
+# Harvest allows 100 requests in any 15 second window. The token bucket allows a burst of
+# RATE_BURST requests and refills at a rate that adds up to the rest of the limit over the window,
+# so that no window can ever see more than the limit.
+RATE_LIMIT = 100
+RATE_WINDOW = 15.0
+RATE_BURST = 10
+UPLOAD_WORKERS = int(os.environ.get("HARVEST_UPLOAD_WORKERS", "8"))
+MAX_ATTEMPTS = 5
+# Where the sync remembers how far through the ledger it got.
+SYNC_CURSOR = os.environ.get(
+    "HARVEST_SYNC_CURSOR",
+    os.path.join(os.path.expanduser("~"), ".litt", "harvest_sync.json"))
+TT_COMMAND = shlex.split(os.environ.get("TT_COMMAND", "tt"))
 
-db = json.loads(sys.stdin.read())
+if sys.stdin.isatty():
+    with open(os.path.join(os.path.expanduser("~"), ".litt", "events.json"),
+              "r") as fp:
+        db = json.loads(fp.read())
+else:
+    db = json.loads(sys.stdin.read())
 
 aliases = db["Aliases"]
 
@@ -30,21 +65,187 @@ def harvest_param_from_tags(alias_values, param):
             return v
 
 
+# Index the aliases by tag, so that matching a record only looks at the aliases that share a tag
+# with it, rather than at every alias.
+alias_order = dict((alias_name, n) for n, alias_name in enumerate(aliases))
+aliases_by_tag = dict()
+for alias_name, alias_values in aliases.items():
+    for tag in set(alias_values["Tags"]):
+        aliases_by_tag.setdefault(tag, list()).append(alias_name)
+
+
 def find_alias(record):
-    max_intersection = None
-    max_intersecting_alias = None
-    for alias_name, alias_values in aliases.items():
-        intersection = set(alias_values["Tags"]).intersection(
-            set(record["Tags"]))
-        if max_intersection is None or len(intersection) > max_intersection:
-            max_intersection = len(intersection)
-            max_intersecting_alias = (alias_name, alias_values)
-    return max_intersecting_alias
-
-
-for record_id, record in db["Records"].items():
-    # Don't double-entry
-    if [t for t in record["Tags"] if t.startswith("HarvestEntryId")] != []:
+    """
+    Return the alias sharing the most tags with the record, preferring the earliest alias on a tie,
+    and the first alias if none share a tag with it.
+    """
+    if aliases == {}:
+        return None
+    intersections = dict()
+    for tag in set(record["Tags"]):
+        for alias_name in aliases_by_tag.get(tag, []):
+            intersections[alias_name] = intersections.get(alias_name, 0) + 1
+    if intersections == {}:
+        alias_name = next(iter(aliases))
+    else:
+        alias_name = min(intersections,
+                         key=lambda a: (-intersections[a], alias_order[a]))
+    return (alias_name, aliases[alias_name])
+
+
+def harvest_entry_id(record):
+    for tag in record["Tags"]:
+        if tag.startswith("HarvestEntryId:"):
+            return int(tag.split(":")[1])
+    return None
+
+
+class TokenBucket(object):
+    """
+    A thread-safe token bucket, where each request takes a token, blocking until one is available.
+    """
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity,
+                                  self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def defer(self, seconds):
+        # Used when the server asks for a pause: take away the tokens that would accrue meanwhile.
+        with self.lock:
+            self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+
+bucket = TokenBucket((RATE_LIMIT - RATE_BURST) / RATE_WINDOW, RATE_BURST)
+session = requests.Session()
+session.mount(
+    HARVEST_API_URL,
+    requests.adapters.HTTPAdapter(pool_connections=1,
+                                  pool_maxsize=UPLOAD_WORKERS))
+session.headers.update({
+    "Harvest-Account-Id": HARVEST_ACCOUNT_ID,
+    "Authorization": "Bearer %s" % HARVEST_PERSONAL_ACCESS_TOKEN,
+    "User-Agent": "litt sync to Harvest",
+    "Content-Type": "application/json"
+})
+
+
+def send_time_entry(record_id, entry_id, record_body):
+    """
+    Create one time entry, or update it if it already has an ID, retrying when rate limited (after
+    the Retry-After the server gives) or on server errors (with exponential backoff). Returns the
+    final response, or None if the request couldn't be made at all.
+    """
+    r = None
+    for attempt in range(MAX_ATTEMPTS):
+        bucket.acquire()
+        try:
+            if entry_id is None:
+                r = session.post("%s/time_entries" % HARVEST_API_URL,
+                                 data=record_body)
+            else:
+                r = session.patch("%s/time_entries/%d" %
+                                  (HARVEST_API_URL, entry_id),
+                                  data=record_body)
+        except requests.RequestException as e:
+            print(record_id, "request failed: %s" % e, file=sys.stderr)
+            time.sleep(2**attempt)
+            continue
+
+        if r.status_code == 429:
+            try:
+                retry_after = float(r.headers.get("Retry-After", 2**attempt))
+            except ValueError:
+                retry_after = 2**attempt
+            bucket.defer(retry_after)
+            time.sleep(retry_after)
+            continue
+        if r.status_code >= 500:
+            time.sleep(2**attempt)
+            continue
+        return r
+    return r
+
+
+def write_back(tags_by_record):
+    """
+    Add tags to records in the ledger with a single `tt exec` script, so that they're all written
+    in one commit, returning whether they were.
+    """
+    script = "".join("amend --id %s %s\n" % (shlex.quote(record_id), " ".join(
+        "-t %s" % shlex.quote(tag) for tag in tags))
+                     for record_id, tags in tags_by_record.items())
+    p = subprocess.run(TT_COMMAND + ["exec", "-"],
+                       input=script,
+                       stdout=subprocess.DEVNULL,
+                       stderr=subprocess.PIPE,
+                       universal_newlines=True)
+    if p.returncode != 0:
+        print("Records couldn't be updated in the ledger: %s" % p.stderr.strip(),
+              file=sys.stderr)
+    return p.returncode == 0
+
+
+def changed_records(since, upto):
+    """
+    Return the IDs of the records changed by the changes to the ledger after sequence number since,
+    up to upto. Merged changes from other replicas are numbered as they're merged, so unlike the
+    records' CommitTime, the sequence number never goes backwards.
+    """
+    p = subprocess.run(TT_COMMAND + ["--output-format", "json-compact", "changes", "--since",
+                                     str(since)],
+                       stdout=subprocess.PIPE,
+                       stderr=subprocess.PIPE,
+                       universal_newlines=True)
+    if p.returncode != 0:
+        print("The ledger's changes couldn't be read: %s" % p.stderr.strip(), file=sys.stderr)
+        sys.exit(p.returncode)
+    return set(change["Id"] for change in json.loads(p.stdout)
+               if change["Kind"] == "Records" and change["Sequence"] <= upto)
+
+
+if os.path.exists(SYNC_CURSOR):
+    with open(SYNC_CURSOR, "r") as fp:
+        cursor = json.loads(fp.read())
+else:
+    cursor = dict(Sequence=None, Retry=[], WrittenBack={})
+
+# The records changed since the last sync, plus the ones that failed to sync last time. Cursors
+# written before the change log was used hold the CommitTime of the last record synced instead.
+upto = db.get("Sequence", 0)
+if cursor.get("Sequence", None) is not None:
+    changed = changed_records(cursor["Sequence"], upto)
+elif cursor.get("CommitTime", None) is not None:
+    changed = set(record_id for record_id, record in db["Records"].items()
+                  if (record["CommitTime"] or 0) > cursor["CommitTime"])
+else:
+    changed = set(db["Records"])
+first_sync = cursor.get("Sequence", None) is None and cursor.get("CommitTime", None) is None
+candidates = [(record_id, record) for record_id, record in db["Records"].items()
+              if record_id in changed or record_id in cursor["Retry"]]
+
+uploads = list()
+for record_id, record in candidates:
+    # The last sync's own amendments (to add the Harvest tags) show up as newly committed records;
+    # they don't need syncing again unless something else has changed them since.
+    if cursor["WrittenBack"].get(record_id, None) == record.get("Version", 1):
+        continue
+    # Without a cursor, records that already have a Harvest entry were synced before it was kept.
+    if first_sync and harvest_entry_id(record) is not None:
         print("Skipping double-entry of %s" % record_id, file=sys.stderr)
         continue
 
@@ -56,11 +257,11 @@ for record_id, record in db["Records"].items():
                 i["Id"]]["EndTime"] - db["Records"][i["Id"]]["StartTime"]
 
     actual_time = wall_clock_time - interruption_time
-    alias_name, alias_values = find_alias(record)
-
-    # Update the tags to include all of the tags of the alias, since the alias may
-    # have been updated since the record was created
-    record["Tags"] = sorted(list(set(record["Tags"] + alias_values["Tags"])))
+    alias = find_alias(record)
+    if alias is None:
+        print(record_id, "SKIPPED due to no aliases", file=sys.stderr)
+        continue
+    alias_name, alias_values = alias
 
     description = record.get("Description", "")
     if description is None:
@@ -92,29 +293,52 @@ for record_id, record in db["Records"].items():
 
     record_body = json.dumps(harvest_record)
     print(record_id, file=sys.stderr)
+    uploads.append((record_id, record, alias_values, record_body))
 
-    if HARVEST_ACCOUNT_ID != "" and HARVEST_PERSONAL_ACCESS_TOKEN != "":
-        # Rate limit to about 60 requests/15 seconds since the official
-        # limit is 100/15 seconds
-        time.sleep(0.25)
-
-        r = requests.post("https://api.harvestapp.com/api/v2/time_entries",
-                          data=record_body,
-                          headers={
-                              "Harvest-Account-Id": HARVEST_ACCOUNT_ID,
-                              "Authorization":
-                              "Bearer %s" % HARVEST_PERSONAL_ACCESS_TOKEN,
-                              "User-Agent": "litt sync to Harvest",
-                              "Content-Type": "application/json"
-                          })
-
-        print(r.status_code, file=sys.stderr)
+if HARVEST_ACCOUNT_ID != "" and HARVEST_PERSONAL_ACCESS_TOKEN != "":
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as pool:
+        responses = list(
+            pool.map(
+                lambda upload: send_time_entry(upload[0], harvest_entry_id(
+                    upload[1]), upload[3]), uploads))
+    elapsed = time.monotonic() - start
 
+    retry = list()
+    tags_by_record = dict()
+    for (record_id, record, alias_values, _), r in zip(uploads, responses):
         try:
-            record["Tags"].append("HarvestEntryId:%d" % r.json()["id"])
+            print(record_id, r.status_code, file=sys.stderr)
+            entry_id = harvest_entry_id(record) or r.json()["id"]
         except:
-            print(r.status_code, file=sys.stderr)
-            print(r.text, file=sys.stderr)
+            if r is not None:
+                print(r.text, file=sys.stderr)
+            retry.append(record_id)
+            continue
+
+        # Bring the record's tags up to date with the alias, since the alias may have been updated
+        # since the record was created, and note the entry it was synced to.
+        tags = sorted(
+            set(alias_values["Tags"] + ["HarvestEntryId:%d" % entry_id]).difference(
+                set(record["Tags"])))
+        if tags != []:
+            tags_by_record[record_id] = tags
+
+    # The amendments are all or nothing, so if they fail, every record is retried next time.
+    written_back = dict()
+    if tags_by_record != dict():
+        if write_back(tags_by_record):
+            written_back = {
+                record_id: db["Records"][record_id].get("Version", 1) + 1
+                for record_id in tags_by_record
+            }
+        else:
+            retry.extend(tags_by_record)
+
+    if uploads != []:
+        print("Uploaded %d entries in %.1fs (%.2f requests/s)" %
+              (len(uploads), elapsed, len(uploads) / elapsed),
+              file=sys.stderr)
 
-with open("events_%d.json" % int(time.time()), "w") as fp:
-    fp.write(json.dumps(db))
+    with open(SYNC_CURSOR, "w") as fp:
+        fp.write(json.dumps(dict(Sequence=upto, Retry=retry, WrittenBack=written_back)))
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+"""
+Drive `tt serve` with many concurrent clients issuing a mix of requests, report the throughput and
+latency percentiles, then check the resulting ledger for lost or duplicated changes and dangling
+interruption references.
+
+By default the server runs in-process behind the Flask test client. With `--socket`, a real
+`tt serve --threads` process is started on a local port instead. Either way it is run against a
+fresh ledger in a temporary HOME, so an existing ledger is never touched.
+
+Exits non-zero if the ledger check finds any problem.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+import threading
+import subprocess
+import http.client
+from argparse import ArgumentParser
+from contextlib import redirect_stderr, nullcontext
+from urllib.parse import urlencode
+
+TT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# The relative weight of each kind of request in the generated traffic.
+DEFAULT_MIX = dict(track=30, ls=30, amend=15, start=8, stop=8, interrupt=4, resume=4)
+
+
+class Results(object):
+    """
+    What each worker saw: the latency and status of every request, and the changes the server
+    acknowledged, which the ledger check expects to find.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = dict()
+        self.statuses = dict()
+        self.created = dict()
+        self.amended = dict()
+
+    def record(self, op, status, latency):
+        with self.lock:
+            self.latencies.setdefault(op, list()).append(latency)
+            key = "%s %d" % (op, status)
+            self.statuses[key] = self.statuses.get(key, 0) + 1
+
+
+def client_requester(app):
+    client = app.test_client()
+
+    def request(method, path, params):
+        response = client.open(path, method=method, query_string=params)
+        return response.status_code, response.get_data(as_text=True)
+
+    return request
+
+
+def socket_requester(port):
+    def request(method, path, params):
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=120)
+        try:
+            conn.request(method, "%s?%s" % (path, urlencode(params)))
+            response = conn.getresponse()
+            return response.status, response.read().decode("utf-8")
+        finally:
+            conn.close()
+
+    return request
+
+
+def worker(worker_id, request, operations, mix, results):
+    rnd = random.Random(worker_id)
+    ops = sorted(mix.keys())
+    weights = [mix[op] for op in ops]
+    mine = list()
+    for n in range(operations):
+        op = rnd.choices(ops, weights)[0]
+        marker = "load-%d-%d" % (worker_id, n)
+        if op == "track":
+            call = ("POST", "/track",
+                    dict(quicktext=marker,
+                         start_time="%d minutes ago" % (n + 2),
+                         end_time="%d minutes ago" % (n + 1)))
+        elif op == "ls":
+            call = ("GET", "/ls", dict(last=rnd.randint(1, 50)))
+        elif op == "amend":
+            if mine == []:
+                continue
+            call = ("PATCH", "/amend", dict(id=rnd.choice(mine), detail=marker))
+        elif op in ["start", "interrupt"]:
+            call = ("POST", "/%s" % op, dict(quicktext=marker))
+        else:
+            call = ("PUT", "/%s" % op, dict())
+
+        start = time.perf_counter()
+        status, body = request(*call)
+        results.record(op, status, time.perf_counter() - start)
+        if status != 200:
+            continue
+
+        if op in ["track", "stop", "resume"]:
+            record_id = json.loads(body)
+            with results.lock:
+                results.created[record_id] = marker if op == "track" else None
+            if op == "track":
+                mine.append(record_id)
+        elif op == "amend":
+            # Only this worker amends its own records, so the last acknowledged amendment of each
+            # is the one that should survive.
+            with results.lock:
+                results.amended[call[2]["id"]] = marker
+
+
+def check_ledger(state, results):
+    """
+    Return a list of the problems found in the final ledger.
+    """
+    problems = list()
+    records = state["Records"]
+    for record_id in results.created:
+        if record_id not in records:
+            problems.append("Lost record: %s" % record_id)
+    for record_id, detail in results.amended.items():
+        if records.get(record_id, dict()).get("Detail", None) != detail:
+            problems.append("Lost amendment of %s: expected Detail %s, found %s" %
+                            (record_id, detail,
+                             records.get(record_id, dict()).get("Detail", None)))
+
+    seen = dict()
+    for record_id, marker in results.created.items():
+        if marker is not None:
+            seen.setdefault(marker, list())
+    for record_id, record in records.items():
+        if record["Description"] in seen:
+            seen[record["Description"]].append(record_id)
+    for marker, record_ids in seen.items():
+        if len(record_ids) > 1:
+            problems.append("Duplicated record %s: %s" % (marker, ", ".join(record_ids)))
+
+    referrers = list(records.items())
+    if state["Stopwatch"] is not None:
+        referrers.append(("Stopwatch", state["Stopwatch"]))
+    for record_id, record in referrers:
+        for interruption in record.get("Interruptions", list()):
+            if interruption["Id"] not in records:
+                problems.append("Dangling interruption %s in %s" %
+                                (interruption["Id"], record_id))
+    return problems
+
+
+def percentile(values, fraction):
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def report(results, elapsed):
+    total = sum(len(v) for v in results.latencies.values())
+    print("%d requests in %.2fs: %.1f req/s" % (total, elapsed, total / elapsed))
+    print("%-10s %7s %9s %9s %9s %9s" % ("Op", "Count", "P50ms", "P90ms", "P99ms", "MaxMs"))
+    for op, latencies in sorted(results.latencies.items()):
+        latencies.sort()
+        print("%-10s %7d %9.1f %9.1f %9.1f %9.1f" %
+              (op, len(latencies), percentile(latencies, 0.5) * 1000,
+               percentile(latencies, 0.9) * 1000, percentile(latencies, 0.99) * 1000,
+               latencies[-1] * 1000))
+    print("Statuses: %s" % ", ".join("%s: %d" % item for item in sorted(results.statuses.items())))
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.strip().split("\n\n")[0])
+    parser.add_argument("-w", "--workers", type=int, default=16,
+                        help="Number of concurrent clients.")
+    parser.add_argument("-n", "--operations", type=int, default=50,
+                        help="Number of requests made by each client.")
+    parser.add_argument("--mix", type=json.loads, default=DEFAULT_MIX,
+                        help="JSON object of the relative weight of each kind of request.")
+    parser.add_argument("--socket", action="store_true", default=False,
+                        help="Run a `tt serve --threads` process and drive it over a socket.")
+    parser.add_argument("--port", type=int, default=9873,
+                        help="Port for the server started with --socket.")
+    parser.add_argument("--threads", type=int, default=16,
+                        help="Threads for the server started with --socket.")
+    pargs = parser.parse_args()
+
+    # Everything below uses a throwaway ledger.
+    os.environ["HOME"] = tempfile.mkdtemp(prefix="tt-load-")
+    sys.path.insert(0, TT_DIR)
+    import tt
+    tt.init_dotfiles()
+
+    server = None
+    if pargs.socket:
+        server = subprocess.Popen([
+            sys.executable, os.path.join(TT_DIR, "tt.py"), "serve", "--port",
+            str(pargs.port), "--threads", str(pargs.threads)
+        ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        request = socket_requester(pargs.port)
+        for _ in range(100):
+            try:
+                request("GET", "/", dict())
+                break
+            except OSError:
+                time.sleep(0.1)
+    else:
+        import tt_serve
+        request = client_requester(tt_serve.create_server(None))
+
+    results = Results()
+    threads = [
+        threading.Thread(target=worker,
+                         args=(n, request, pargs.operations, pargs.mix, results))
+        for n in range(pargs.workers)
+    ]
+    start = time.perf_counter()
+    try:
+        # In-process, the server's messages for rejected requests would drown out the report.
+        with redirect_stderr(open(os.devnull, "w")) if server is None else nullcontext():
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+    finally:
+        elapsed = time.perf_counter() - start
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    report(results, elapsed)
+    with open(os.path.join(os.environ["HOME"], ".litt", "events.json"), "r") as fp:
+        problems = check_ledger(json.loads(fp.read()), results)
+    print("Ledger in %s: %d acknowledged records, %d amended, %d problems" %
+          (os.environ["HOME"], len(results.created), len(results.amended), len(problems)))
+    for problem in problems:
+        print("  %s" % problem)
+    sys.exit(1 if problems != [] else 0)
+
+
+if __name__ == "__main__":
+    main()
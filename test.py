@@ -1,10 +1,18 @@
 #!/usr/bin/env python3
 
 import imp
+import os
+import sys
+import json
+import shutil
+import tempfile
 import unittest
+import subprocess
 import collections
 
-imp.load_source("tt", "./tt")
+imp.load_source("tt", "./tt.py")
+
+TT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tt.py")
 
 
 class LITTTest(unittest.TestCase):
@@ -27,5 +35,103 @@ class StopwatchTests(LITTTest):
     pass
 
 
+class SyncTests(LITTTest):
+    """
+    Replicate between two devices, each with its own scratch HOME, through a shared directory.
+    """
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.shared = os.path.join(self.root, "shared")
+        self.homes = [os.path.join(self.root, device) for device in ["a", "b"]]
+        for home in self.homes:
+            os.makedirs(home)
+            self.tt(home, "ls")
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def tt(self, home, *argv):
+        p = subprocess.run([sys.executable, TT, "--output-format", "json-compact"] +
+                           list(argv),
+                           env=dict(os.environ, HOME=home),
+                           stdout=subprocess.PIPE,
+                           stderr=subprocess.PIPE,
+                           universal_newlines=True,
+                           check=True)
+        return json.loads(p.stdout) if p.stdout != "" else None
+
+    def sync(self, *homes):
+        for home in homes:
+            self.tt(home, "sync", "--dir", self.shared)
+
+    def ledger(self, home):
+        with open(os.path.join(home, ".litt", "events.json"), "r") as fp:
+            state = json.loads(fp.read())
+        return state["Records"], state["Aliases"]
+
+    def device(self, home):
+        with open(os.path.join(home, ".litt", "device_id"), "r") as fp:
+            return fp.read().strip()
+
+    def tombstones(self, home):
+        with open(os.path.join(home, ".litt", "events.json"), "r") as fp:
+            return json.loads(fp.read()).get("Tombstones", dict()).get("Records", dict())
+
+    def test_replicas_converge(self):
+        a, b = self.homes
+        record_id = self.tt(a, "track", "-s", "2 hours ago", "-e", "1 hour ago", "Planning")
+        self.tt(b, "alias", "-k", "dev", "-d", "Development")
+        self.sync(a, b, a)
+        self.assertEqual(self.ledger(a), self.ledger(b))
+        self.assertIn(record_id, self.ledger(b)[0])
+        self.assertIn("dev", self.ledger(a)[1])
+
+    def test_delete_and_concurrent_edit_converge(self):
+        a, b = self.homes
+        record_id = self.tt(a, "track", "-s", "2 hours ago", "-e", "1 hour ago", "Planning")
+        self.sync(a, b)
+
+        # Both edits are to version 1, so the deletion (version 2) and the amendment (version 2)
+        # tie, and the device with the greater ID wins on both replicas.
+        self.tt(a, "rm", "--id", record_id)
+        self.tt(b, "amend", "--id", record_id, "-d", "Planning, amended")
+        self.sync(a, b, a)
+
+        self.assertEqual(self.ledger(a), self.ledger(b))
+        deleted_wins = self.device(a) > self.device(b)
+        self.assertEqual(record_id not in self.ledger(a)[0], deleted_wins)
+
+    def test_stale_edit_doesnt_resurrect(self):
+        a, b = self.homes
+        record_id = self.tt(a, "track", "-s", "2 hours ago", "-e", "1 hour ago", "Planning")
+        self.sync(a, b)
+
+        # The deletion follows a second amendment, so outranks the other device's single one.
+        self.tt(a, "amend", "--id", record_id, "-d", "Planning, amended")
+        self.tt(a, "rm", "--id", record_id)
+        self.tt(b, "amend", "--id", record_id, "-d", "Planning, amended elsewhere")
+        self.sync(b, a, b)
+
+        self.assertEqual(self.ledger(a), self.ledger(b))
+        self.assertNotIn(record_id, self.ledger(a)[0])
+
+    def test_compact_prunes_sent_tombstones(self):
+        a, b = self.homes
+        record_id = self.tt(a, "track", "-s", "2 hours ago", "-e", "1 hour ago", "Planning")
+        self.sync(a, b)
+        self.tt(a, "rm", "--id", record_id)
+
+        # The deletion hasn't been sent anywhere yet, so its tombstone is kept.
+        self.tt(a, "changes", "--compact")
+        self.assertIn(record_id, self.tombstones(a))
+
+        self.sync(a)
+        self.tt(a, "changes", "--compact")
+        self.assertNotIn(record_id, self.tombstones(a))
+
+        self.sync(b)
+        self.assertNotIn(record_id, self.ledger(b)[0])
+
+
 if __name__ == "__main__":
     unittest.main()
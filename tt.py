@@ -16,19 +16,37 @@ Exit codes:
 - 9: Attempt to edit a record with an ID that doesn't exist.
 - 10: A hook failed to execute properly
 - 11: A sortkey was specified for `tt ls`, but the key doesn't exist for one or more items in the log
+- 12: The records couldn't be sorted or paged as requested by `tt ls`, or `tt changes` was asked
+  for fewer than one change
 - 13: An attempt was made to stop a tracked interval with an ongoing interruption.
+- 14: An amendment was made conditional on a version of the record that is no longer current.
+- 15: Changes received from another replica of the ledger couldn't be merged.
+- 16: A `tt exec` script contained a command that can't be run from a script.
+- 17: The ledgers given to `tt ls --ledger` couldn't be found or read, or don't have distinct names.
 - 127: A dryrun was specified.
 """
 
 import os
 import sys
+import time
+
+# Taken before the remaining imports so that `--profile` can report how long they took.
+__IMPORT_START = time.perf_counter()
+
 import copy
 import json
-import time
+import shlex
+import threading
+import operator
 import base64
+import heapq
+from bisect import bisect_left, bisect_right
 from os.path import isdir, isfile  # pylint: disable=C0412
 from os.path import join as pathjoin  # pylint: disable=C0412
+from os.path import basename
+from io import StringIO
 from argparse import ArgumentParser
+from contextlib import contextmanager, nullcontext
 
 try:
     import yaml
@@ -39,6 +57,66 @@ VALID_RECORD_SORT_KEYS = [
     "CommitTime", "StartTime", "EndTime", "Description", "ID", "Detail"
 ]
 
+# Size, in bytes, at which the performance log in the dotdirectory rolls over to a new generation.
+# Overridden by the PerfLogBytes configuration key, where a value of 0 disables the log.
+PERF_LOG_BYTES = 512 * 1024
+
+# Number of times the background hook worker attempts delivery of a queued payload before leaving
+# it for `tt hooks drain`, and the cap, in seconds, on the exponential backoff between attempts.
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_MAX_BACKOFF = 300
+OUTBOX_POLL_INTERVAL = 1.0
+
+# The comparisons permitted in the Condition of a timespec filter for `tt ls`.
+TIMESPEC_CONDITIONS = {
+    "<": operator.lt,
+    "<=": operator.le,
+    "==": operator.eq,
+    "!=": operator.ne,
+    ">=": operator.ge,
+    ">": operator.gt
+}
+
+# The columns of the CSV written by `tt ls --csv` that aren't tags, which `tt import` reads back.
+CSV_COLUMNS = [
+    "RecordId", "StartTime", "EndTime", "CommitTime", "Duration",
+    "InterruptionDuration", "Description", "Detail", "StructuredData"
+]
+
+# The layouts the ledger can be written to disk in, selected by the StorageLayout configuration key:
+# "json" pretty-prints the whole ledger, and "lines" writes each record and alias on its own line.
+STORAGE_LAYOUTS = ["json", "lines"]
+
+# Each line of the change log starts with this, followed by the sequence number of the change, so
+# that lines can be selected by sequence number without parsing them.
+CHANGE_LINE_PREFIX = '{"Sequence": '
+
+# Number of changes requested at a time when pulling them from a peer with `tt sync --peer`, and the
+# timeout, in seconds, of each request to the peer.
+SYNC_PAGE_SIZE = 1000
+SYNC_TIMEOUT = 30
+
+# The device IDs of the ledgers used by this process, by dotdirectory.
+__DEVICE_IDS = dict()
+
+__IMPORTS_DONE = time.perf_counter()
+
+
+class CommandError(Exception):
+    """
+    Raised when a command cannot be carried out, carrying the exit code documented above. The CLI
+    exits with the code, while the server and batch callers report it.
+    """
+
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+
+def __fail(code, message):
+    print(message, file=sys.stderr)
+    raise CommandError(code, message)
+
 
 def __record_sort_keys(k):
     if k in VALID_RECORD_SORT_KEYS:
@@ -57,6 +135,13 @@ def __dotdir():
         return pathjoin(os.environ.get("HOME", ""), ".litt")
 
 
+def dotdir_path():
+    """
+    Return the path of the LITT directory, for the tools built on this module, such as tt serve.
+    """
+    return __dotdir()
+
+
 def check_dotfile():
     """
     Check the dotfiles for an existing database structure.
@@ -97,52 +182,560 @@ def init_dotfiles():
             json.dumps({"OutputFormat": "json"}, indent=2, sort_keys=True))
 
 
-def load_hooks():
+def new_timings(command=None):
     """
-    List all files in the hook directories, and determine which are suitable for execution as hook
-    events.
+    Create an empty timing record for a single CLI invocation or server request. Phases map a
+    phase name to the total wall-clock seconds spent in it, and hooks record each hook executable
+    that was run.
+    """
+    return dict(Command=command, Phases=dict(), Hooks=list())
+
+
+@contextmanager
+def timed_phase(timings, phase):
+    """
+    Accumulate the wall-clock time spent in the body of the with-statement against the named
+    phase. A timings value of None disables the bookkeeping.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if timings is not None:
+            timings["Phases"][phase] = timings["Phases"].get(
+                phase, 0.0) + time.perf_counter() - start
+
+
+def __start_profiling(pargs):
+    """
+    Start the optional cProfile and tracemalloc instrumentation requested on the command line.
+    """
+    profiler = None
+    if pargs.profile_stats is not None:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    if pargs.profile_memory:
+        import tracemalloc
+        tracemalloc.start()
+    return profiler
+
+
+def __finish_profiling(pargs, profiler, timings):
+    """
+    Stop any running profilers, saving the cProfile statistics and recording peak memory usage.
+    """
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(pargs.profile_stats)
+    if pargs.profile_memory:
+        import tracemalloc
+        timings["PeakMemory"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+
+def __print_profile(timings, outfile=sys.stderr):
+    """
+    Print a human readable breakdown of where the wall-clock time of an invocation went.
+    """
+    width = max([len(k) for k in timings["Phases"].keys()] + [
+        len("%s/%s" % (h["Event"], h["Hook"])) + 2 for h in timings["Hooks"]
+    ] + [len("total")])
+    print("%s  %10s" % ("Phase".ljust(width), "ms"), file=outfile)
+    for phase, duration in timings["Phases"].items():
+        print("%s  %10.2f" % (phase.ljust(width), duration * 1000),
+              file=outfile)
+        for hook in timings["Hooks"]:
+            if hook["Event"] == phase:
+                print("%s  %10.2f" %
+                      (("  %s/%s" %
+                        (hook["Event"], hook["Hook"])).ljust(width),
+                       hook["Duration"] * 1000),
+                      file=outfile)
+    if "Total" in timings:
+        print("%s  %10.2f" % ("total".ljust(width), timings["Total"] * 1000),
+              file=outfile)
+    if "PeakMemory" in timings:
+        print("Peak traced memory: %.1f KiB" %
+              (timings["PeakMemory"] / 1024.0),
+              file=outfile)
+
+
+def append_perf_record(timings, source):
+    """
+    Append a compact timing record for one invocation or request to the performance log in the
+    dotdirectory. The log is a two-generation ring buffer: once perf.jsonl grows past PerfLogBytes
+    it replaces perf.1.jsonl, keeping the disk usage bounded without ever rewriting records.
+    """
+    try:
+        with open(pathjoin(__dotdir(), "config.json"), "r") as fp:
+            limit = json.loads(fp.read()).get("PerfLogBytes", PERF_LOG_BYTES)
+    except (OSError, ValueError):
+        return
+
+    if not limit:
+        return
+
+    record = dict(
+        Time=round(time.time(), 3),
+        Source=source,
+        Command=timings["Command"],
+        LedgerRecords=timings.get("LedgerRecords", None),
+        BytesWritten=timings.get("BytesWritten", 0),
+        ExitCode=timings.get("ExitCode", 0),
+        Total=round(timings.get("Total", 0.0), 6),
+        Phases={k: round(v, 6)
+                for k, v in timings["Phases"].items()},
+        Hooks=[
+            dict(Hook="%s/%s" % (h["Event"], h["Hook"]),
+                 Duration=round(h["Duration"], 6)) for h in timings["Hooks"]
+        ])
+
+    log_path = pathjoin(__dotdir(), "perf.jsonl")
+    with open(log_path, "a") as ofp:
+        ofp.write(json.dumps(record, sort_keys=True, separators=(",", ":")) +
+                  "\n")
+        size = ofp.tell()
+
+    if size > limit:
+        os.replace(log_path, pathjoin(__dotdir(), "perf.1.jsonl"))
+
+
+def __read_perf_records():
+    """
+    Read all of the records still retained in the performance log, oldest first.
+    """
+    records = list()
+    for log_name in ["perf.1.jsonl", "perf.jsonl"]:
+        try:
+            with open(pathjoin(__dotdir(), log_name), "r") as fp:
+                for line in fp:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        # A partially written line, from an interrupted append.
+                        pass
+        except FileNotFoundError:
+            pass
+    return records
+
+
+def __percentile(sorted_values, pct):
+    # Nearest-rank percentile of an already sorted, non-empty, list.
+    rank = max(int(round(pct / 100.0 * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+HOOK_EVENTS = [
+    "pre_load", "pre_commit", "post_commit", "post_commit_async",
+    "pre_config_write", "post_config_write"
+]
+
+
+def __hooks_signature():
     """
+    The mode and modification time of each file in the hook directories, and of the hook manifest,
+    which together determine whether a cached hook listing is still valid. Files are stat()ed
+    individually, as making a hook executable (or not) doesn't change its directory.
+    """
+    signature = dict()
+    for path in HOOK_EVENTS + ["hooks.json"]:
+        fullpath = pathjoin(__dotdir(), "hooks", path)
+        try:
+            if isdir(fullpath):
+                signature[path] = {
+                    entry.name: [entry.stat().st_mode, entry.stat().st_mtime_ns]
+                    for entry in os.scandir(fullpath)
+                }
+            else:
+                stat = os.stat(fullpath)
+                signature[path] = [stat.st_mode, stat.st_mtime_ns]
+        except FileNotFoundError:
+            signature[path] = None
+    return signature
+
+
+def __scan_hooks():
     from os import listdir, access, X_OK
-    hooks = dict(pre_load=list(),
-                 pre_commit=list(),
-                 post_commit=list(),
-                 pre_config_write=list(),
-                 post_config_write=list())
+    try:
+        with open(pathjoin(__dotdir(), "hooks", "hooks.json"), "r") as fp:
+            manifest = json.loads(fp.read())
+    except FileNotFoundError:
+        manifest = dict()
 
+    hooks = {hook_key: list() for hook_key in HOOK_EVENTS}
     for hook_key, binaries in hooks.items():
         try:
-            for hookfile in listdir("%s/hooks/%s" % (__dotdir(), hook_key)):
+            for hookfile in sorted(
+                    listdir("%s/hooks/%s" % (__dotdir(), hook_key))):
                 hook_fullpath = "%s/hooks/%s/%s" % (__dotdir(), hook_key,
                                                     hookfile)
                 if isfile(hook_fullpath) and access(hook_fullpath, X_OK):
-                    binaries.append(hook_fullpath)
-            binaries.sort()
+                    options = manifest.get("%s/%s" % (hook_key, hookfile),
+                                           dict())
+                    binaries.append(
+                        dict(Path=hook_fullpath,
+                             Name="%s/%s" % (hook_key, hookfile),
+                             Commands=options.get("Commands", None),
+                             Tags=options.get("Tags", None),
+                             MinInterval=options.get("MinInterval", None),
+                             Timeout=options.get("Timeout", None),
+                             Stage=options.get("Stage", None)))
         except FileNotFoundError:  # pylint: disable=E0602
             pass
 
     return hooks
 
 
-def run_hooks(hookevent, hooks, data):
+def load_hooks():
+    """
+    List all files in the hook directories, and determine which are suitable for execution as hook
+    events, along with the options declared for each in the hooks/hooks.json manifest.
+
+    The listing is cached in the dotdirectory, and only rebuilt when a hook is added, removed, or
+    modified (including its permissions), or the manifest is modified.
+    """
+    signature = __hooks_signature()
+    cache_path = pathjoin(__dotdir(), "hooks_cache.json")
+    try:
+        with open(cache_path, "r") as fp:
+            cache = json.loads(fp.read())
+        if cache["Signature"] == signature:
+            return cache["Hooks"]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    hooks = __scan_hooks()
+    try:
+        __write_durably(
+            cache_path,
+            json.dumps(dict(Signature=signature, Hooks=hooks), sort_keys=True))
+    except OSError:
+        pass
+    return hooks
+
+
+def __canonical_command(command):
+    # Hooks filter on the full command name, not its CLI shorthand.
+    return dict(i="interrupt", r="resume").get(command, command)
+
+
+def __image_tags(data):
+    tags = set()
+    if isinstance(data, dict):
+        for image_key in ["OldImage", "NewImage"]:
+            for item in (data.get(image_key, None) or dict()).values():
+                if isinstance(item, dict):
+                    tags.update(item.get("Tags", None) or [])
+    return tags
+
+
+def __applicable_hooks(hookevent, hooks, data, command):
+    """
+    Select the hooks for an event whose declared commands and record tags match the event, and
+    that haven't run more recently than their declared minimum interval.
+    """
+    applicable = list()
+    last_runs = None
+    for hook in hooks[hookevent]:
+        if command is not None and hook["Commands"] is not None and __canonical_command(
+                command) not in hook["Commands"]:
+            continue
+        if hook["Tags"] is not None and hookevent in [
+                "pre_commit", "post_commit", "post_commit_async"
+        ] and __image_tags(data).isdisjoint(hook["Tags"]):
+            continue
+        if hook["MinInterval"] is not None:
+            if last_runs is None:
+                last_runs = __hook_last_runs()
+            if time.time() - last_runs.get(hook["Name"],
+                                           0) < hook["MinInterval"]:
+                continue
+        applicable.append(hook)
+    return applicable
+
+
+def __hook_last_runs():
+    try:
+        with open(pathjoin(__dotdir(), "hooks_state.json"), "r") as fp:
+            return json.loads(fp.read())
+    except (OSError, ValueError):
+        return dict()
+
+
+def __record_hook_run(hook):
+    last_runs = __hook_last_runs()
+    last_runs[hook["Name"]] = time.time()
+    __write_durably(pathjoin(__dotdir(), "hooks_state.json"),
+                    json.dumps(last_runs, sort_keys=True))
+
+
+def __hook_stages(hooks):
+    """
+    Group hooks into the stages they are run in. Hooks that declare a stage are ordered by their
+    stage number and then name, and those that declare the same stage form one stage. Hooks without
+    a declared stage then follow, each a stage of its own, so that by default hooks run one at a
+    time in lexicographical order.
+    """
+    stages = list()
+    for hook in sorted(hooks,
+                       key=lambda h: (h.get("Stage", None) is None,
+                                      h.get("Stage", None) or 0, h["Name"])):
+        if stages != [] and hook.get("Stage", None) is not None and stages[-1][
+                -1].get("Stage", None) == hook["Stage"]:
+            stages[-1].append(hook)
+        else:
+            stages.append([hook])
+    return stages
+
+
+def run_hooks(hookevent, hooks, data, timings=None, command=None):
     """
     Run all hooks for a given event name, passing the JSON serialized data into the hook on stdin.
+    Hooks whose manifest options exclude the command or changed records are not run, and hooks
+    that share a stage are run concurrently. If any hook fails, the remaining stages are abandoned
+    once the failing hook's stage completes.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    def run(hook):
+        hook_start = time.perf_counter()
+        result = __run_hook(hook["Path"], hookevent, data, hook["Timeout"])
+        return result + (time.perf_counter() - hook_start, )
+
+    with timed_phase(timings, hookevent):
+        for stage in __hook_stages(
+                __applicable_hooks(hookevent, hooks, data, command)):
+            if len(stage) == 1:
+                results = [run(stage[0])]
+            else:
+                with ThreadPoolExecutor(max_workers=len(stage)) as pool:
+                    results = list(pool.map(run, stage))
+
+            failed = False
+            for hook, (returncode, stdout, stderr,
+                       duration) in zip(stage, results):
+                if timings is not None:
+                    timings["Hooks"].append(
+                        dict(Event=hookevent,
+                             Hook=basename(hook["Path"]),
+                             Duration=duration,
+                             ReturnCode=returncode))
+
+                if returncode != 0:
+                    failed = True
+                    print("%s hook %s returned non-zero, aborting." %
+                          (hookevent, basename(hook["Path"])),
+                          file=sys.stderr)
+                    print(stdout.decode("utf-8"))
+                    print(stderr.decode("utf-8"))
+                elif hook["MinInterval"] is not None:
+                    __record_hook_run(hook)
+
+            if failed:
+                __fail(10, "%s hooks failed." % hookevent)
+
+
+def __run_hook(hookfile, hookevent, data, timeout=None):
+    """
+    Run a single hook executable, passing the JSON serialized data on stdin, and return its return
+    code and output. A hook still running after the timeout, in seconds, is killed and reported as
+    having failed.
     """
     import subprocess
-    for hookfile in hooks[hookevent]:
-        proc = subprocess.Popen((hookfile, hookevent),
-                                stdout=subprocess.PIPE,
-                                stdin=subprocess.PIPE,
-                                stderr=subprocess.PIPE,
-                                cwd=__dotdir())
-        proc.stdin.write(json.dumps(data, sort_keys=True).encode("utf-8"))
+    proc = subprocess.Popen((hookfile, hookevent),
+                            stdout=subprocess.PIPE,
+                            stdin=subprocess.PIPE,
+                            stderr=subprocess.PIPE,
+                            cwd=__dotdir())
+    try:
+        stdout, stderr = proc.communicate(
+            json.dumps(data, sort_keys=True).encode("utf-8"), timeout=timeout)
+    except subprocess.TimeoutExpired:
+        proc.kill()
         stdout, stderr = proc.communicate()
+        stderr += ("Hook timed out after %s seconds." % timeout).encode("utf-8")
+        return -1, stdout, stderr
+    return proc.returncode, stdout, stderr
 
-        if proc.returncode != 0:
-            print("%s hook returned non-zero, aborting." % hookevent,
-                  file=sys.stderr)
-            print(stdout.decode("utf-8"))
-            print(stderr.decode("utf-8"))
-            sys.exit(10)
+
+@contextmanager
+def __file_lock(path, blocking=True):
+    """
+    Hold an exclusive advisory lock on the given lock file for the body of the with-statement. The
+    value bound by the with-statement is False if the lock was not acquired because it is held
+    elsewhere and blocking was not requested.
+    """
+    lock_fp = open(path, "a+")
+    try:
+        try:
+            if sys.platform == "win32":
+                import msvcrt
+                lock_fp.seek(0)
+                msvcrt.locking(lock_fp.fileno(),
+                               msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK,
+                               1)
+            else:
+                import fcntl
+                fcntl.flock(lock_fp.fileno(),
+                            fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except OSError:
+            acquired = False
+        else:
+            acquired = True
+        yield acquired
+    finally:
+        # Closing the file releases any lock held on it.
+        lock_fp.close()
+
+
+@contextmanager
+def ledger_lock(timings=None):
+    """
+    Hold the lock that serializes loading, changing and writing the ledger between every process
+    using it, timing the wait for it as its own phase.
+    """
+    start = time.perf_counter()
+    with __file_lock(pathjoin(__dotdir(), ".ledger.lock")):
+        if timings is not None:
+            timings["Phases"]["lock_wait"] = timings["Phases"].get(
+                "lock_wait", 0.0) + time.perf_counter() - start
+        yield
+
+
+def __write_durably(path, text):
+    """
+    Replace the file at the given path with the given text such that, once this returns, the new
+    content is on stable storage and a crash leaves either the old or the new file, never a mix.
+    """
+    tmp_path = "%s.tmp" % path
+    with open(tmp_path, "w") as ofp:
+        ofp.write(text)
+        ofp.flush()
+        os.fsync(ofp.fileno())
+    os.replace(tmp_path, path)
+
+
+def __outbox_dir():
+    return pathjoin(__dotdir(), "outbox")
+
+
+def __enqueue_async_hooks(hookevent, hooks, data, command=None):
+    """
+    Durably queue the data for delivery to each of the applicable hooks of the given asynchronous
+    event, in the order it was committed. Returns whether anything was queued.
+    """
+    applicable = __applicable_hooks(hookevent, hooks, data, command)
+    if applicable == []:
+        return False
+
+    os.makedirs(__outbox_dir(), exist_ok=True)
+    entry = dict(Event=hookevent,
+                 Created=time.time(),
+                 Payload=data,
+                 Pending={
+                     hook["Path"]: dict(Attempts=0,
+                                        NextAttempt=0,
+                                        LastError=None,
+                                        Timeout=hook["Timeout"])
+                     for hook in applicable
+                 })
+    # Entry file names sort in commit order, with the PID to disambiguate concurrent writers.
+    __write_durably(
+        pathjoin(__outbox_dir(), "%020d-%d.json" % (time.time_ns(), os.getpid())),
+        json.dumps(entry, sort_keys=True))
+    return True
+
+
+def __outbox_entries():
+    try:
+        return sorted([
+            name for name in os.listdir(__outbox_dir())
+            if name.endswith(".json")
+        ])
+    except FileNotFoundError:
+        return []
+
+
+def __spawn_outbox_worker():
+    """
+    Start a detached `tt hooks drain --background` process to deliver the queued hook payloads,
+    without waiting for it.
+    """
+    import subprocess
+    kwargs = dict(stdin=subprocess.DEVNULL,
+                  stdout=subprocess.DEVNULL,
+                  stderr=subprocess.DEVNULL,
+                  cwd=__dotdir())
+    if sys.platform == "win32":
+        kwargs["creationflags"] = (subprocess.DETACHED_PROCESS
+                                   | subprocess.CREATE_NEW_PROCESS_GROUP)
+    else:
+        kwargs["start_new_session"] = True
+    subprocess.Popen([
+        sys.executable,
+        os.path.abspath(__file__), "hooks", "drain", "--background"
+    ], **kwargs)
+
+
+def __drain_outbox(force):
+    """
+    Make one pass over the outbox, delivering each queued payload to each hook that has not yet
+    accepted it. Delivery is ordered per hook: once a payload fails for a hook, later payloads are
+    held back for that hook until it succeeds. Failed deliveries are retried with exponential
+    backoff, up to OUTBOX_MAX_ATTEMPTS times unless forced.
+
+    Returns the number of undelivered entries, and the earliest time one of them may be retried
+    (None if none of them will be retried without being forced).
+    """
+    blocked = set()
+    remaining = 0
+    # The time each hook may next be retried, taken from the oldest entry still pending for it.
+    retry_times = dict()
+    for name in __outbox_entries():
+        entry_path = pathjoin(__outbox_dir(), name)
+        with open(entry_path, "r") as fp:
+            entry = json.loads(fp.read())
+
+        for hookfile, delivery in sorted(entry["Pending"].items()):
+            if hookfile in blocked:
+                continue
+            if not isfile(hookfile):
+                print("Hook %s no longer exists, dropping its queued payload." %
+                      hookfile,
+                      file=sys.stderr)
+                del entry["Pending"][hookfile]
+                continue
+            if not force and (delivery["Attempts"] >= OUTBOX_MAX_ATTEMPTS or
+                              delivery["NextAttempt"] > time.time()):
+                blocked.add(hookfile)
+                if delivery["Attempts"] < OUTBOX_MAX_ATTEMPTS:
+                    retry_times[hookfile] = delivery["NextAttempt"]
+                continue
+
+            returncode, stdout, stderr = __run_hook(
+                hookfile, entry["Event"], entry["Payload"],
+                delivery.get("Timeout", None))
+            if returncode == 0:
+                del entry["Pending"][hookfile]
+            else:
+                blocked.add(hookfile)
+                delivery["Attempts"] += 1
+                delivery["NextAttempt"] = time.time() + min(
+                    2**delivery["Attempts"], OUTBOX_MAX_BACKOFF)
+                delivery["LastError"] = (
+                    stdout.decode("utf-8", "replace") +
+                    stderr.decode("utf-8", "replace"))[-1024:]
+                if delivery["Attempts"] < OUTBOX_MAX_ATTEMPTS:
+                    retry_times[hookfile] = delivery["NextAttempt"]
+
+        if entry["Pending"] == {}:
+            os.remove(entry_path)
+        else:
+            __write_durably(entry_path, json.dumps(entry, sort_keys=True))
+            remaining += 1
+
+    return remaining, (min(retry_times.values()) if retry_times else None)
 
 
 def __human_alias(alias):
@@ -240,10 +833,58 @@ def __write_output(obj,
         if human_hint == "ID":
             # It's just an ID string, so just print it out saying so.
             print("Committed Record ID: %s" % obj, file=outfile)
-        elif human_hint == "Config":
-            # It is the configuration object, so print it in pseudo-yaml
+        elif human_hint in ["Config", "Sync", "Import"]:
+            # It is the configuration object, or the counts of a sync or import, so print it in
+            # pseudo-yaml
             for k, v in obj.items():
                 print("%s: %s" % (str(k), str(v)), file=outfile)
+        elif human_hint == "Perf":
+            # A list of flat summary rows, printed as a fixed-width table.
+            columns = [
+                "Kind", "Name", "Period", "Count", "P50Ms", "P90Ms", "P99Ms",
+                "MaxMs", "MeanLedgerRecords"
+            ]
+            widths = [
+                max([len(col)] + [len(str(row[col])) for row in obj])
+                for col in columns
+            ]
+            print("  ".join([c.ljust(w) for c, w in zip(columns, widths)]),
+                  file=outfile)
+            for row in obj:
+                print("  ".join(
+                    [str(row[c]).ljust(w) for c, w in zip(columns, widths)]),
+                      file=outfile)
+        elif human_hint == "Outbox":
+            for entry in obj:
+                print("Entry \"%s\" (%s, queued at %s)" %
+                      (entry["Entry"], entry["Event"],
+                       __timestamp_to_iso(entry["Created"])),
+                      file=outfile)
+                for hook in entry["Pending"]:
+                    print("    %s: %d attempt(s)%s" %
+                          (hook["Hook"], hook["Attempts"],
+                           "" if hook["LastError"] is None else
+                           ", last error: %s" % hook["LastError"].strip()),
+                          file=outfile)
+        elif human_hint == "Selection":
+            # The records selected by a command that acts on many records at once.
+            print("%d record(s)" % obj["Count"], file=outfile)
+            for record_id in obj["Ids"]:
+                print("    %s" % record_id, file=outfile)
+            if obj.get("Updated", []) != []:
+                print("Updated %d record(s) that referred to them:" % len(obj["Updated"]),
+                      file=outfile)
+                for record_id in obj["Updated"]:
+                    print("    %s" % record_id, file=outfile)
+        elif human_hint == "Changes":
+            for change in obj:
+                print("%d %s %s %s %s" %
+                      (change["Sequence"], __timestamp_to_iso(change["Time"]),
+                       "Created" if change["OldImage"] is None else
+                       "Deleted" if change["NewImage"] is None else "Updated",
+                       dict(Records="Record", Aliases="Alias")[change["Kind"]],
+                       change["Id"]),
+                      file=outfile)
         elif human_hint.startswith("Alias"):
             # This will always be a dictionary mapping alias keys to parameter sets.
             for key, alias in obj.items():
@@ -277,34 +918,572 @@ def __write_output(obj,
             raise ValueError("Undefined human hint '%s'" % human_hint)
 
 
-def __load_state():
+def load_state(timings=None):
     """
     Load time tracking events from the DB in the dotdirectory.
     """
-    with open(pathjoin(__dotdir(), "events.json"), "r") as fp:
-        state = json.loads(fp.read())
-    with open(pathjoin(__dotdir(), "config.json"), "r") as fp:
-        config = json.loads(fp.read())
+    return __read_ledger(timings), __load_config(timings)
+
 
-    return state, config
+def __read_ledger(timings=None, dotdir=None):
+    """
+    Load time tracking events from the DB in the given dotdirectory, or the user's own.
+    """
+    with timed_phase(timings, "read"):
+        with open(pathjoin(dotdir or __dotdir(), "events.json"), "r") as fp:
+            events_text = fp.read()
+    with timed_phase(timings, "parse"):
+        return json.loads(events_text)
 
 
-def __write_state(state, hooks):
+def __load_config(timings=None):
     """
-    Save time tracking events to the dotfile
+    Load the persistent configuration from the dotdirectory.
     """
-    with open("%s/events.json" % __dotdir(), "w") as ofp:
-        ofp.write(json.dumps(state, indent=2, sort_keys=True))
+    with timed_phase(timings, "read"):
+        with open(pathjoin(__dotdir(), "config.json"), "r") as fp:
+            config_text = fp.read()
+    with timed_phase(timings, "parse"):
+        return json.loads(config_text)
+
+
+def __serialize_state(state, layout="json"):
+    """
+    Serialize the state in the given storage layout. Either way the result is a JSON document with
+    its keys sorted, so anything that reads the ledger can read both.
+
+    In the "lines" layout, each record and alias is on its own line, in order of ID, and everything
+    else (the stopwatch, interruption, and counters) each on a line of its own, so that a change to
+    the ledger changes only the lines of what changed. Commas lead, rather than trail, each item
+    after the first, so that adding an item to the end doesn't change the line before it.
+    """
+    if layout != "lines":
+        return json.dumps(state, indent=2, sort_keys=True)
+
+    lines = ["{"]
+    for n, key in enumerate(sorted(state.keys())):
+        lead = "" if n == 0 else ","
+        if key in ["Records", "Aliases"] and state[key] != dict():
+            lines.append("%s%s: {" % (lead, json.dumps(key)))
+            lines += [
+                "%s%s: %s" % ("" if m == 0 else ",", json.dumps(item_id),
+                              json.dumps(state[key][item_id], sort_keys=True))
+                for m, item_id in enumerate(sorted(state[key].keys()))
+            ]
+            lines.append("}")
+        else:
+            lines.append("%s%s: %s" %
+                         (lead, json.dumps(key), json.dumps(state[key], sort_keys=True)))
+    lines.append("}")
+    return "\n".join(lines) + "\n"
+
+
+def __write_state(state, hooks, timings=None, base=None, config=None):
+    """
+    Save time tracking events to the dotfile, returning the number of bytes written. Nothing is
+    written, and 0 returned, if the state is unchanged from what is already on disk.
+
+    If the state the changes were made to is given, the changes to its records and aliases are
+    first appended to the change log. The state is written in the storage layout of the config, if
+    given.
+    """
+    layout = "json" if config is None else config.get("StorageLayout", "json")
+    with timed_phase(timings, "serialize"):
+        serialized = __serialize_state(state, layout)
+    with timed_phase(timings, "write"):
+        try:
+            with open("%s/events.json" % __dotdir(), "r") as fp:
+                if fp.read() == serialized:
+                    return 0
+        except FileNotFoundError:
+            pass
+    # The ledger version only moves when the content does, so that readers can use it to tell
+    # whether anything they've previously seen is stale.
+    state["Version"] = state.get("Version", 0) + 1
+    if base is not None:
+        __append_changes(base, state, timings)
+    with timed_phase(timings, "serialize"):
+        serialized = __serialize_state(state, layout)
+    with timed_phase(timings, "write"):
+        __write_durably("%s/events.json" % __dotdir(), serialized)
+    return len(serialized)
+
+
+def __ledger_signature():
+    """
+    Return a value that changes whenever the ledger file is replaced or rewritten, which is cheap
+    enough to check on every request as it only needs a stat() of the file.
+    """
+    st = os.stat(pathjoin(__dotdir(), "events.json"))
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def snapshot_signature():
+    # A snapshot of the ledger is stale once either the ledger or the config has changed.
+    return (__ledger_signature(),
+            os.stat(pathjoin(__dotdir(), "config.json")).st_mtime_ns)
+
+
+def __commit(state,
+             hooks,
+             images,
+             timings=None,
+             command=None,
+             base=None,
+             config=None):
+    """
+    Write the state to disk, surrounded by the pre_commit and post_commit hooks which receive the
+    images of the changed items. If the ledger changed, the images are then queued for the
+    post_commit_async hooks, which are delivered by a background worker so that the caller doesn't
+    wait on them.
+    """
+    return __commit_group(state, hooks, {command: images}, timings, base,
+                          config)
+
+
+def __commit_group(state,
+                   hooks,
+                   images_by_command,
+                   timings=None,
+                   base=None,
+                   config=None):
+    """
+    Write a state reached by one or more commands in a single write, running each commit hook event
+    once for each command with the images of that command's changes.
+    """
+    written = write_group(state, hooks, images_by_command, timings, base,
+                          config)
+    finish_group(hooks, images_by_command, written, timings)
+    return written
+
+
+def write_group(state,
+                hooks,
+                images_by_command,
+                timings=None,
+                base=None,
+                config=None):
+    """
+    The first half of __commit_group: run the pre_commit hooks and write the state, returning the
+    number of bytes written. This is the part of a commit done while holding the ledger lock.
+    """
+    for command, images in images_by_command.items():
+        run_hooks("pre_commit", hooks, images, timings, command)
+    return __write_state(state, hooks, timings, base, config)
+
+
+def finish_group(hooks, images_by_command, written, timings=None):
+    """
+    The second half of __commit_group: queue the post_commit_async hooks if anything was written,
+    and run the post_commit hooks. This is done once the ledger lock has been released, so that
+    these hooks can run tt themselves. The changes are committed by now, so the async hooks are
+    queued first, and still run if a post_commit hook fails.
+    """
+    enqueued = []
+    if written != 0 and hooks["post_commit_async"] != []:
+        with timed_phase(timings, "post_commit_async"):
+            enqueued = [
+                __enqueue_async_hooks("post_commit_async", hooks, images,
+                                      command)
+                for command, images in images_by_command.items()
+            ]
+    try:
+        for command, images in images_by_command.items():
+            run_hooks("post_commit", hooks, images, timings, command)
+    finally:
+        if any(enqueued):
+            __spawn_outbox_worker()
+
+
+def fork_state(state):
+    """
+    Copy the state cheaply enough to do before every operation, so that a failed operation can be
+    rolled back by discarding the copy. Records and aliases are shared with the original, which is
+    safe because commands replace, rather than modify in place, the records and aliases they
+    change.
+    """
+    fork = dict(state)
+    fork["Records"] = dict(state["Records"])
+    fork["Aliases"] = dict(state["Aliases"])
+    fork["Stopwatch"] = copy.deepcopy(state["Stopwatch"])
+    fork["Interruption"] = copy.deepcopy(state["Interruption"])
+    if "Tombstones" in state:
+        fork["Tombstones"] = {
+            kind: dict(tombstones)
+            for kind, tombstones in state["Tombstones"].items()
+        }
+    return fork
+
+
+def __changes_path():
+    return pathjoin(__dotdir(), "changes.jsonl")
+
+
+def __item_changes(base, state):
+    """
+    Return the (kind, key, old item, new item) of each record and alias that differs between two
+    states. Since commands replace, rather than modify in place, the items they change, an item is
+    unchanged exactly when both states hold the same object for it.
+    """
+    changes = list()
+    for kind in ["Records", "Aliases"]:
+        old_items = base[kind]
+        new_items = state[kind]
+        for key, item in new_items.items():
+            old_item = old_items.get(key, None)
+            if old_item is not item:
+                changes.append((kind, key, old_item, item))
+        for key, old_item in old_items.items():
+            if key not in new_items:
+                changes.append((kind, key, old_item, None))
+    return changes
+
+
+def __append_changes(base, state, timings=None):
+    """
+    Give each change made to the records and aliases of the base state a sequence number, and
+    durably append it to the change log, before the state recording the last sequence number is
+    written.
+
+    A tombstone is kept in the state for each item deleted, holding the (version, device ID) of its
+    deletion, so that a replica that merges a concurrent change to it can tell which came last. An
+    item created where there is a tombstone takes the version after it.
+    """
+    changes = __item_changes(base, state)
+    if changes == []:
+        return
+    sequence = state.get("Sequence", 0)
+    commit_time = time.time()
+    lines = list()
+    with timed_phase(timings, "serialize"):
+        for n, (kind, key, old_item, new_item) in enumerate(changes):
+            tombstone = state.get("Tombstones", dict()).get(kind, dict()).get(key, None)
+            if new_item is None:
+                # Deletions merged from other replicas already have their tombstone.
+                if tombstone is None or tuple(tombstone) < __item_clock(old_item):
+                    tombstone = [__item_clock(old_item)[0] + 1, __device_id()]
+                    state.setdefault("Tombstones", dict()).setdefault(kind,
+                                                                      dict())[key] = tombstone
+            elif tombstone is not None:
+                del state["Tombstones"][kind][key]
+                if old_item is None and tuple(tombstone) >= __item_clock(new_item):
+                    new_item = dict(new_item, Version=tombstone[0] + 1)
+                    state[kind][key] = new_item
+                    changes[n] = (kind, key, old_item, new_item)
+            sequence += 1
+            # Not sorted, so that the sequence number comes first.
+            lines.append(
+                json.dumps(
+                    dict(Sequence=sequence,
+                         Time=commit_time,
+                         Kind=kind,
+                         Id=key,
+                         Device=tombstone[1] if new_item is None else
+                         new_item.get("Device", None),
+                         OldImage=old_item,
+                         NewImage=new_item,
+                         **(dict(Version=tombstone[0]) if new_item is None else dict()))))
+    with timed_phase(timings, "write"):
+        with open(__changes_path(), "a") as ofp:
+            ofp.write("".join(line + "\n" for line in lines))
+            ofp.flush()
+            os.fsync(ofp.fileno())
+    state["Sequence"] = sequence
+
+
+def __change_lines(upto):
+    """
+    Return the lines of the change log up to the given sequence number, by sequence number.
+
+    A change is logged before the ledger recording it is written, so if that write fails, the
+    change is left in the log with a sequence number past the ledger's. Its sequence number is then
+    reused, and the change logged again, by the next write; so the last line logged with each
+    sequence number is the one that counts, and lines past the ledger's are ignored.
+    """
+    lines = dict()
+    try:
+        with open(__changes_path(), "r") as fp:
+            for line in fp:
+                if not line.startswith(CHANGE_LINE_PREFIX):
+                    continue
+                sequence = int(line[len(CHANGE_LINE_PREFIX):line.index(",")])
+                if sequence <= upto:
+                    lines[sequence] = line
+    except FileNotFoundError:
+        pass
+    return lines
+
+
+def __read_changes(since, upto, limit=None):
+    """
+    Return the changes after sequence number since, up to upto (the ledger's sequence number), in
+    order, and only the first limit of them if a limit is given.
+    """
+    lines = __change_lines(upto)
+    sequences = sorted(sequence for sequence in lines if sequence > since)
+    if limit is not None:
+        sequences = sequences[:limit]
+    return [json.loads(lines[sequence]) for sequence in sequences]
+
+
+def __compact_changes(upto):
+    """
+    Rewrite the change log keeping only the latest change to each record and alias, returning the
+    number of changes before and after. This must be done holding the ledger lock.
+    """
+    lines = __change_lines(upto)
+    latest = dict()
+    for sequence in sorted(lines):
+        change = json.loads(lines[sequence])
+        latest[(change["Kind"], change["Id"])] = sequence
+    kept = sorted(latest.values())
+    __write_durably(__changes_path(), "".join(lines[sequence] for sequence in kept))
+    return len(lines), len(kept)
+
+
+def __prune_tombstones(state, upto):
+    """
+    Drop the tombstones of the deletions that every directory and peer this device syncs with has
+    already been sent, returning the number dropped. Nothing is dropped before the first sync, as
+    there's no telling then which replicas have yet to hear of a deletion.
+    """
+    cursors = __load_sync_cursors()
+    sent = [cursor["Exported"] for cursor in cursors.get("Directories", dict()).values()
+            ] + [cursor["Pushed"] for cursor in cursors.get("Peers", dict()).values()]
+    if sent == []:
+        return 0
+    pruned = 0
+    tombstones = state.get("Tombstones", dict())
+    for change in __read_changes(0, min(min(sent), upto)):
+        if change["NewImage"] is not None:
+            continue
+        kind_tombstones = tombstones.get(change["Kind"], dict())
+        # A later deletion of the same item, merged or local, has its own tombstone.
+        if tuple(kind_tombstones.get(change["Id"], ())) == __change_clock(change):
+            del kind_tombstones[change["Id"]]
+            pruned += 1
+    return pruned
+
+
+def __device_id():
+    """
+    Return the ID of this replica of the ledger, generating it the first time. It is kept in its
+    own file, rather than in the ledger or config, since those may be copied between machines.
+    """
+    dotdir = __dotdir()
+    if dotdir not in __DEVICE_IDS:
+        path = pathjoin(dotdir, "device_id")
+        try:
+            with open(path, "r") as fp:
+                __DEVICE_IDS[dotdir] = fp.read().strip()
+        except FileNotFoundError:
+            import uuid
+            device_id = uuid.uuid4().hex[:12]
+            with open(path, "w") as ofp:
+                ofp.write(device_id + "\n")
+            __DEVICE_IDS[dotdir] = device_id
+    return __DEVICE_IDS[dotdir]
+
+
+def __item_clock(item):
+    # Items from before devices were recorded sort before those written by any device.
+    return (item.get("Version", 1), item.get("Device", None) or "")
+
+
+def __change_clock(change):
+    if change["NewImage"] is not None:
+        return __item_clock(change["NewImage"])
+    # A deletion is the version after the one deleted, which is logged along with it.
+    return (change.get("Version", None) or __item_clock(change["OldImage"] or dict())[0] + 1,
+            change.get("Device", None) or "")
+
+
+def apply_changes(state, changes):
+    """
+    Merge changes made by other replicas into the state. For each record and alias, whichever of the
+    local and incoming versions has the greater (version, device ID) wins, so that replicas that
+    have seen the same changes agree, whatever order they saw them in. A deleted item is compared
+    by the version of its tombstone. Returns the images of the items that changed, or None if none
+    did; a deletion of an item that was never seen here only updates its tombstone.
+    """
+    images = dict(OldImage=dict(), NewImage=dict())
+    for change in changes:
+        if not isinstance(change, dict) or change.get("Kind", None) not in [
+                "Records", "Aliases"
+        ] or not isinstance(change.get("Id", None), str) or not isinstance(
+                change.get("NewImage", None), (dict, type(None))) or not isinstance(
+                    change.get("OldImage", None), (dict, type(None))) or not isinstance(
+                        change.get("Version", None), (int, type(None))):
+            __fail(15, "Malformed change: %s" % json.dumps(change))
+
+        items = state[change["Kind"]]
+        tombstones = state.get("Tombstones", dict()).get(change["Kind"], dict())
+        local_item = items.get(change["Id"], None)
+        if local_item is not None:
+            local_clock = __item_clock(local_item)
+        else:
+            local_clock = tuple(tombstones.get(change["Id"], None) or (0, ""))
+        if __change_clock(change) <= local_clock:
+            continue
+
+        if change["NewImage"] is None:
+            state.setdefault("Tombstones", dict()).setdefault(
+                change["Kind"], dict())[change["Id"]] = list(__change_clock(change))
+            if local_item is None:
+                continue
+            del items[change["Id"]]
+        else:
+            tombstones.pop(change["Id"], None)
+            items[change["Id"]] = change["NewImage"]
+        if change["Id"] not in images["OldImage"]:
+            images["OldImage"][change["Id"]] = local_item
+        images["NewImage"][change["Id"]] = change["NewImage"]
+
+    return images if images["NewImage"] != dict() else None
+
+
+def __own_changes(since, upto):
+    # The changes made on this device, as opposed to those merged in from other replicas.
+    device_id = __device_id()
+    return [
+        change for change in __read_changes(since, upto)
+        if change.get("Device", None) == device_id
+    ]
+
+
+def __sync_directory(path, state, cursors):
+    """
+    Exchange changes through a shared directory, which holds an append-only journal of the changes
+    made on each device. This device's changes since the last exchange are appended to its own
+    journal, and the other devices' journals are read from where the last exchange left off.
+    Returns the changes read, and the number of changes exported.
+    """
+    device_id = __device_id()
+    cursor = cursors.setdefault("Directories", dict()).setdefault(
+        os.path.abspath(path), dict(Exported=0, Imported=dict()))
+    os.makedirs(path, exist_ok=True)
+
+    upto = state.get("Sequence", 0)
+    exported = __own_changes(cursor["Exported"], upto)
+    if exported != []:
+        with open(pathjoin(path, "%s.jsonl" % device_id), "a") as ofp:
+            ofp.write("".join(json.dumps(change) + "\n" for change in exported))
+            ofp.flush()
+            os.fsync(ofp.fileno())
+    cursor["Exported"] = upto
+
+    changes = list()
+    for name in sorted(os.listdir(path)):
+        if not name.endswith(".jsonl") or name == "%s.jsonl" % device_id:
+            continue
+        offset = cursor["Imported"].get(name, 0)
+        with open(pathjoin(path, name), "rb") as fp:
+            fp.seek(offset)
+            data = fp.read()
+        # A line still being appended by its device is left for the next exchange.
+        end = data.rfind(b"\n") + 1
+        changes += [
+            json.loads(line) for line in data[:end].decode("utf-8").splitlines()
+            if line != ""
+        ]
+        cursor["Imported"][name] = offset + end
+    return changes, len(exported)
+
+
+def __sync_peer(url, preshared_key, state, cursors):
+    """
+    Exchange changes with a peer running `tt serve`, pushing this device's changes since the last
+    exchange to it, and pulling the changes made on other devices from its change log, from where
+    the last exchange left off. Returns the changes pulled, and the number of changes pushed.
+    """
+    import urllib.request
+    from urllib.parse import urlencode
+    url = url.rstrip("/")
+    headers = {"Content-Type": "application/json"}
+    if preshared_key is not None:
+        headers["Authorization"] = "Bearer %s" % preshared_key
+    cursor = cursors.setdefault("Peers", dict()).setdefault(
+        url, dict(Pushed=0, Pulled=0))
+
+    upto = state.get("Sequence", 0)
+    pushed = __own_changes(cursor["Pushed"], upto)
+    if pushed != []:
+        urllib.request.urlopen(urllib.request.Request(
+            "%s/sync" % url,
+            data=json.dumps(pushed).encode("utf-8"),
+            headers=headers,
+            method="POST"),
+                               timeout=SYNC_TIMEOUT).read()
+    cursor["Pushed"] = upto
+
+    device_id = __device_id()
+    changes = list()
+    while True:
+        with urllib.request.urlopen(urllib.request.Request(
+                "%s/changes?%s" %
+            (url,
+             urlencode(
+                 dict(since=cursor["Pulled"],
+                      limit=SYNC_PAGE_SIZE,
+                      output_format="json-compact"))),
+                headers=headers),
+                                    timeout=SYNC_TIMEOUT) as response:
+            page = json.loads(response.read().decode("utf-8"))
+        # The peer's log includes the changes it merged from this device.
+        changes += [
+            change for change in page if change.get("Device", None) != device_id
+        ]
+        if page != []:
+            cursor["Pulled"] = page[-1]["Sequence"]
+        if len(page) < SYNC_PAGE_SIZE:
+            break
+    return changes, len(pushed)
+
+
+def __sync_cursors_path():
+    return pathjoin(__dotdir(), "sync.json")
+
+
+def __load_sync_cursors():
+    try:
+        with open(__sync_cursors_path(), "r") as fp:
+            return json.loads(fp.read())
+    except FileNotFoundError:
+        return dict()
+
+
+def __write_sync_cursors(cursors):
+    __write_durably(__sync_cursors_path(), json.dumps(cursors, indent=2, sort_keys=True))
+
+
+def merge_images(images_list):
+    """
+    Combine the images returned by several commands into the images of a single commit: the old
+    image of an item is the one from before its first change, and the new image is the one after
+    its last change.
+    """
+    merged = None
+    for images in images_list:
+        if images is None:
+            continue
+        if merged is None:
+            merged = dict(OldImage=dict(), NewImage=dict())
+        for key, value in (images.get("NewImage", None) or dict()).items():
+            if key not in merged["OldImage"]:
+                merged["OldImage"][key] = (images.get("OldImage", None)
+                                           or dict()).get(key, None)
+            merged["NewImage"][key] = value
+    return merged
 
 
 def __write_config(config, hooks):
     """
     Save the configuration to the persistent file for future invocations.
     """
-    run_hooks("pre_config_write", hooks, config)
+    run_hooks("pre_config_write", hooks, config, command="config")
     with open("%s/config.json" % __dotdir(), "w") as ofp:
         ofp.write(json.dumps(config, indent=2, sort_keys=True))
-    run_hooks("post_config_write", hooks, config)
+    run_hooks("post_config_write", hooks, config, command="config")
 
 
 def cmd_base(pargs, state, config, outfile=sys.stdout):
@@ -331,7 +1510,7 @@ def cmd_config(pargs, _, config, hooks):
     """
     Handle configuration commands include printing the configuration and updating values.
     """
-    options = dict(output_format="OutputFormat")
+    options = dict(output_format="OutputFormat", storage_layout="StorageLayout")
 
     opts = dict([(optkey, getattr(pargs, optkey))
                  for optkey in options.keys()])  # pylint: disable=C0201
@@ -380,6 +1559,9 @@ def cmd_alias(pargs, state, config):
                 del state["Aliases"][pargs.key]
             images["NewImage"] = {pargs.key: None}
         else:
+            # Aliases are versioned like records, so that replicas can tell which change is latest.
+            alias["Version"] = (images["OldImage"][pargs.key] or dict()).get("Version", 0) + 1
+            alias["Device"] = __device_id()
             state["Aliases"][pargs.key] = alias
             images["NewImage"] = {pargs.key: alias}
 
@@ -451,6 +1633,8 @@ def __create_record(pargs, state):
         Description=pargs.description,
         Detail=pargs.detail,
         StructuredData=pargs.structured_data,
+        Version=1,
+        Device=__device_id(),
     )
 
     return record
@@ -461,12 +1645,7 @@ def cmd_start(pargs, state, _, outfile=sys.stdout):
     Start a stopwatch to track time against a task
     """
     if state["Stopwatch"] is not None:
-        print("Stopwatch currently running, ignoring current request",
-              file=sys.stderr)
-        if outfile == sys.stdout:
-            sys.exit(1)
-        else:
-            return None
+        __fail(1, "Stopwatch currently running, ignoring current request")
 
     record = __create_record(pargs, state)
     if pargs.start_time is not None:
@@ -494,42 +1673,45 @@ def __update_record(old_record_prototype, pargs, state):
     # Given the pargs value, create the record for it, and then throw away any keys that have a
     # value of None (the sentinel for "not supplied"; don't clobber a value in the old record that
     # was unspecified in the new one).
-    new_record = dict([(k, v)
-                       for k, v in __create_record(pargs, state).items()
-                       if v is not None])
+    return __apply_update(old_record_prototype, __create_record(pargs, state),
+                          pargs.untag)
+
+
+def __apply_update(old_record_prototype, updates, untag):
+    # Apply the values of a record created from the arguments to a copy of the old record, as
+    # __update_record does, so that many records can be updated from the same arguments.
+    new_record = dict([(k, v) for k, v in updates.items() if v is not None])
 
     del new_record["StartTime"]
     old_record = copy.deepcopy(old_record_prototype)
     new_record["Tags"] = list(
-        set(old_record["Tags"] + new_record["Tags"]).difference(
-            set(pargs.untag)))
+        set(old_record["Tags"] + new_record["Tags"]).difference(set(untag)))
+    # Every change to a record is a new version of it. Records from before versions were kept are
+    # taken to be at version 1.
+    new_record["Version"] = __record_version(old_record) + 1
     old_record.update(new_record)
     return old_record
 
 
+def __record_version(record):
+    return record.get("Version", 1)
+
+
 def cmd_stop(pargs, state, config, outfile=sys.stdout):
     """
     Start a stopwatch to track time against a task
     """
     if state["Interruption"] is not None:
-        print("Interruption is in progress, ignoring current request",
-              file=sys.stderr)
-        if outfile == sys.stdout:
-            sys.exit(13)
-        else:
-            return None
+        __fail(13, "Interruption is in progress, ignoring current request")
     if state["Stopwatch"] is None:
-        print("Stopwatch not currently running, ignoring current request",
-              file=sys.stderr)
-        if outfile == sys.stdout:
-            sys.exit(2)
-        else:
-            return None
+        __fail(2, "Stopwatch not currently running, ignoring current request")
 
     if pargs.id is None:
         pargs.id = __generate_id(state)
 
     record = __update_record(state["Stopwatch"], pargs, state)
+    # The record is new to the ledger, whatever changes the stopwatch went through.
+    record["Version"] = 1
 
     if pargs.end_time is not None:
         record["EndTime"] = __parse_time(pargs.end_time)
@@ -589,13 +1771,9 @@ def cmd_interrupt(pargs, state, config, outfile=sys.stdout):
     else:
         # Confirm that there are no ongoing interruptions
         if state["Interruption"] is not None:
-            print(
-                "Unable to interrupt task, as existing interruption is in progress.",
-                file=sys.stderr)
-            if outfile == sys.stdout:
-                sys.exit(3)
-            else:
-                return None
+            __fail(
+                3,
+                "Unable to interrupt task, as existing interruption is in progress.")
         # Since at this point, there's no ongoing interruptions, add a new one to the end of the
         # Interruptions list
         record = __create_record(pargs, state)
@@ -609,25 +1787,18 @@ def cmd_resume(pargs, state, config, outfile=sys.stdout):
     Resume an interrupted stopwatch by cleaning up and writing the event to the ledger.
     """
     if state["Stopwatch"] is None:
-        print("Unable to resume from interruption with no stopwatch running.",
-              file=sys.stderr)
-        if outfile == sys.stdout:
-            sys.exit(4)
-        else:
-            return None
+        __fail(
+            4,
+            "Unable to resume from interruption with no stopwatch running.")
     else:
         # Confirm that the interruption that's most recent exists and is indeed still open
         if state["Interruption"] is None:
-            print("Unable to resume without an open interruption.",
-                  file=sys.stderr)
-            if outfile == sys.stdout:
-                sys.exit(5)
-            else:
-                return None
+            __fail(5, "Unable to resume without an open interruption.")
         # Since there's an open interruption, close it out.
         if pargs.id is None:
             pargs.id = __generate_id(state)
         record = __update_record(state["Interruption"], pargs, state)
+        record["Version"] = 1
         state["Records"][pargs.id] = record
         state["Interruption"] = None
         state["Stopwatch"]["Interruptions"].append(dict(Id=pargs.id))
@@ -637,13 +1808,19 @@ def cmd_resume(pargs, state, config, outfile=sys.stdout):
 
 
 def __parse_time(timespec):
+    timestamp = __timespec_timestamp(timespec)
+    if timestamp is None:
+        __fail(8, "Unable to parse your timespec \"%s\"." % timespec)
+    return timestamp
+
+
+def __timespec_timestamp(timespec):
+    # As __parse_time, but returning None for a timespec that can't be parsed.
     from dateparser import parse as datetimeparser
     from dateutil.tz import tzlocal
     dto = datetimeparser(timespec)
     if dto is None:
-        print("Unable to parse your timespec \"%s\"." % timespec,
-              file=sys.stderr)
-        sys.exit(8)
+        return None
     if dto.tzinfo is None:
         return dto.replace(tzinfo=tzlocal()).timestamp()
     return dto.timestamp()
@@ -659,13 +1836,9 @@ def cmd_track(pargs, state, config, outfile=sys.stdout):
     cur_time = time.time()
 
     if pargs.start_time is None and pargs.end_time is None:
-        print(
-            "At least one of start and end of a finite interval must be specified.",
-            file=sys.stderr)
-        if outfile == sys.stdout:
-            sys.exit(6)
-        else:
-            return None
+        __fail(
+            6,
+            "At least one of start and end of a finite interval must be specified.")
 
     # Since the above check guarantees at least one was specified, set the other to
     # a timezone aware "now" (in UTC).
@@ -678,13 +1851,9 @@ def cmd_track(pargs, state, config, outfile=sys.stdout):
     end_time = __parse_time(pargs.end_time)
 
     if end_time - start_time <= 0:
-        print(
-            "For finite-interval tracking, the end time must be strictly after the start time.",
-            file=sys.stderr)
-        if outfile == sys.stdout:
-            sys.exit(7)
-        else:
-            return None
+        __fail(
+            7,
+            "For finite-interval tracking, the end time must be strictly after the start time.")
 
     record = __create_record(pargs, state)
     record["StartTime"] = start_time
@@ -692,7 +1861,7 @@ def cmd_track(pargs, state, config, outfile=sys.stdout):
     record["CommitTime"] = cur_time
 
     if pargs.dryrun:
-        __write_output(record, pargs, config, "Record.Complete")
+        __write_output(record, pargs, config, "Record.Complete", outfile=outfile)
         if outfile == sys.stdout:
             sys.exit(127)
         else:
@@ -709,22 +1878,17 @@ def cmd_amend(pargs, state, config, outfile=sys.stdout):
     """
     Amend the properties of a tracked record
     """
+    if getattr(pargs, "filter", []) != []:
+        return __amend_selected(pargs, state, config, outfile)
+
     if pargs.id is None and state["Stopwatch"] is None:
-        print(
-            "No record ID specified, and no stopwatch running to default to.",
-            file=sys.stderr)
-        if outfile == sys.stdout:
-            sys.exit(9)
-        else:
-            return None
+        __fail(
+            9,
+            "No record ID specified, and no stopwatch running to default to.")
 
     # First, check that the ID specified exists.
     if pargs.id is not None and pargs.id not in state["Records"]:
-        print("Specified record ID does not exist.", file=sys.stderr)
-        if outfile == sys.stdout:
-            sys.exit(9)
-        else:
-            return None
+        __fail(9, "Specified record ID does not exist.")
 
     # If the ID exists, create a new record from the arguments, and then clobber the record pulled
     # from the ledger.
@@ -741,6 +1905,14 @@ def cmd_amend(pargs, state, config, outfile=sys.stdout):
         old_record = state["Records"][pargs.id]
         record = __update_record(old_record, pargs, state)
 
+    # With --if-version, the amendment only applies to the version of the record the caller last
+    # saw, so that a concurrent change isn't silently overwritten.
+    if pargs.if_version is not None and __record_version(
+            old_record) != pargs.if_version:
+        __fail(
+            14, "The record is at version %d, not %d, so it has changed since it was read." %
+            (__record_version(old_record), pargs.if_version))
+
     # Reset the timestamps in the record to what the original record was, then we'll replace as
     # necessary based on what is provided in the pargs attributes.
     record["StartTime"] = old_record["StartTime"]
@@ -761,6 +1933,290 @@ def cmd_amend(pargs, state, config, outfile=sys.stdout):
     return images
 
 
+def __amend_selected(pargs, state, config, outfile=sys.stdout):
+    """
+    Amend every record matching the filters given to `tt amend --filter` (and the ID, if given) in
+    one pass, returning the images of all of them.
+    """
+    if pargs.id is not None and pargs.id not in state["Records"]:
+        __fail(9, "Specified record ID does not exist.")
+    selected = select_records(state, [] if pargs.id is None else [pargs.id],
+                              pargs.filter)
+
+    if pargs.if_version is not None:
+        changed = sorted(record_id for record_id, record in selected.items()
+                         if __record_version(record) != pargs.if_version)
+        if changed != []:
+            __fail(
+                14, "Records not at version %d, so changed since they were read: %s" %
+                (pargs.if_version, ", ".join(changed)))
+
+    # The arguments, and any timespecs in them, are only resolved once for every record.
+    updates = __create_record(pargs, state)
+    start_time = None if pargs.start_time is None else __parse_time(
+        pargs.start_time)
+    end_time = None if pargs.end_time is None else __parse_time(pargs.end_time)
+
+    amended = dict()
+    for record_id, old_record in selected.items():
+        record = __apply_update(old_record, updates, pargs.untag)
+        record["StartTime"] = old_record[
+            "StartTime"] if start_time is None else start_time
+        record["EndTime"] = old_record["EndTime"] if end_time is None else end_time
+        amended[record_id] = record
+
+    __write_output(dict(Count=len(amended), Ids=sorted(amended)),
+                   pargs,
+                   config,
+                   "Selection",
+                   outfile=outfile)
+    if pargs.dryrun:
+        if outfile == sys.stdout:
+            sys.exit(127)
+        else:
+            return None
+
+    state["Records"].update(amended)
+    return dict(OldImage=selected, NewImage=amended) if amended != dict() else None
+
+
+def cmd_rm(pargs, state, config, outfile=sys.stdout):
+    """
+    Delete the records with the given IDs, or matching the given filters, along with any of their
+    interruptions that nothing else refers to.
+    """
+    if pargs.id == [] and pargs.filter == []:
+        __fail(9, "No records specified; give at least one --id or --filter.")
+    missing = [record_id for record_id in pargs.id if record_id not in state["Records"]]
+    if missing != []:
+        __fail(9, "Specified record IDs do not exist: %s" % ", ".join(missing))
+    deleted = set(select_records(state, pargs.id, pargs.filter).keys())
+
+    # Which records (or the stopwatch) refer to each interruption.
+    referrers = [(record_id, record) for record_id, record in state["Records"].items()]
+    if state["Stopwatch"] is not None:
+        referrers.append((None, state["Stopwatch"]))
+    referred_by = dict()
+    for referrer_id, record in referrers:
+        for interruption in record.get("Interruptions", []):
+            referred_by.setdefault(interruption["Id"], set()).add(referrer_id)
+
+    # An interruption is orphaned once everything that refers to it is deleted.
+    pending = list(deleted)
+    while pending != []:
+        for interruption in state["Records"][pending.pop()].get("Interruptions", []):
+            interruption_id = interruption["Id"]
+            if interruption_id in state["Records"] and interruption_id not in deleted and \
+                    referred_by[interruption_id].issubset(deleted):
+                deleted.add(interruption_id)
+                pending.append(interruption_id)
+
+    # Records left behind (and the stopwatch) drop their references to deleted interruptions.
+    updated = dict()
+    stopwatch = state["Stopwatch"]
+    for referrer_id, record in referrers:
+        if referrer_id in deleted:
+            continue
+        interruptions = [
+            i for i in record.get("Interruptions", []) if i["Id"] not in deleted
+        ]
+        if len(interruptions) == len(record.get("Interruptions", [])):
+            continue
+        if referrer_id is None:
+            stopwatch = dict(record, Interruptions=interruptions)
+        else:
+            record = copy.deepcopy(record)
+            record["Interruptions"] = interruptions
+            record["Version"] = __record_version(record) + 1
+            record["Device"] = __device_id()
+            updated[referrer_id] = record
+
+    __write_output(dict(Count=len(deleted), Ids=sorted(deleted), Updated=sorted(updated)),
+                   pargs,
+                   config,
+                   "Selection",
+                   outfile=outfile)
+    if pargs.dryrun:
+        if outfile == sys.stdout:
+            sys.exit(127)
+        else:
+            return None
+
+    images = dict(OldImage=dict(), NewImage=dict())
+    for record_id in sorted(deleted):
+        images["OldImage"][record_id] = state["Records"].pop(record_id)
+        images["NewImage"][record_id] = None
+    for record_id, record in updated.items():
+        images["OldImage"][record_id] = state["Records"][record_id]
+        images["NewImage"][record_id] = record
+        state["Records"][record_id] = record
+    state["Stopwatch"] = stopwatch
+    return images if images["NewImage"] != dict() else None
+
+
+def __import_timestamp(value, parsed):
+    """
+    Convert a timestamp of an imported row to a Unix timestamp: either a number, an ISO 8601
+    timestamp (such as `tt ls --csv` writes), or any other timespec. Every distinct string is only
+    parsed once per import, and only strings that aren't numbers or ISO 8601 are given to the
+    (comparatively slow) timespec parser.
+    """
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    if value not in parsed:
+        from datetime import datetime
+        try:
+            parsed[value] = float(value)
+        except ValueError:
+            try:
+                # Timestamps without a timezone are local, as for any other timespec.
+                parsed[value] = datetime.fromisoformat(value).timestamp()
+            except ValueError:
+                parsed[value] = __timespec_timestamp(value)
+    if parsed[value] is None:
+        # Not printed here, as the error is reported against its row.
+        raise CommandError(8, "Unable to parse your timespec \"%s\"." % value)
+    return parsed[value]
+
+
+def __import_rows(infile, fmt):
+    """
+    Yield the rows of an NDJSON or CSV file as record-like dictionaries, one at a time.
+    """
+    if fmt == "csv":
+        from csv import DictReader
+        for row in DictReader(infile):
+            # Columns other than the known ones are tags, marked with an 'x'.
+            yield dict([(k, v) for k, v in row.items() if k in CSV_COLUMNS],
+                       Tags=[
+                           k for k, v in row.items()
+                           if k not in CSV_COLUMNS and k is not None and v == "x"
+                       ])
+    else:
+        for line in infile:
+            if line.strip() != "":
+                # A line that isn't JSON is yielded as its error, to be reported against its row.
+                try:
+                    yield json.loads(line)
+                except ValueError as exc:
+                    yield exc
+
+
+def __import_key(record):
+    # Imported rows may only have whole-second timestamps (as `tt ls --csv` writes), so records
+    # are compared on whole seconds.
+    return (int(record["StartTime"]), int(record["EndTime"]),
+            record.get("Description", None) or "")
+
+
+def cmd_import(pargs, state, config, outfile=sys.stdout):
+    """
+    Import records from an NDJSON or CSV file, skipping any that duplicate a record already in the
+    ledger, and committing all of them at once.
+    """
+    fmt = pargs.format
+    if fmt is None:
+        fmt = "csv" if pargs.file.lower().endswith(".csv") else "ndjson"
+
+    # An index of the records already in the ledger, and those imported so far, by their key.
+    index = {
+        __import_key(record): record_id
+        for record_id, record in state["Records"].items()
+        if record.get("StartTime", None) is not None
+        and record.get("EndTime", None) is not None
+    }
+    # The IDs given to rows in the file, and the IDs of the records they were imported as (or
+    # found to duplicate), which references to them between rows are rewritten to.
+    row_ids = dict()
+    parsed = dict()
+    commit_time = time.time()
+    imported = dict()
+    counts = dict(Imported=0, Duplicates=0, Invalid=0)
+
+    infile = sys.stdin if pargs.file == "-" else open(pargs.file, "r", newline="")
+    try:
+        for n, row in enumerate(__import_rows(infile, fmt), 1):
+            try:
+                if isinstance(row, ValueError):
+                    raise row
+                if not isinstance(row, dict):
+                    raise CommandError(6, "Each row must be an object.")
+                if row.get("StartTime", None) in [None, ""] or row.get(
+                        "EndTime", None) in [None, ""]:
+                    raise CommandError(
+                        6, "Both the start and end of each record must be given.")
+                start_time = __import_timestamp(row["StartTime"], parsed)
+                end_time = __import_timestamp(row["EndTime"], parsed)
+                if end_time - start_time <= 0:
+                    raise CommandError(
+                        7, "The end time must be strictly after the start time.")
+            except (CommandError, ValueError) as exc:
+                if not pargs.skip_invalid:
+                    __fail(getattr(exc, "code", 8), "Row %d: %s" % (n, exc))
+                print("Skipping row %d: %s" % (n, exc), file=sys.stderr)
+                counts["Invalid"] += 1
+                continue
+
+            record = dict(
+                CommitTime=commit_time,
+                StartTime=start_time,
+                EndTime=end_time,
+                Tags=sorted(set((row.get("Tags", None) or []) + pargs.tag)),
+                Description=row.get("Description", None) or None,
+                Detail=row.get("Detail", None) or None,
+                StructuredData=row.get("StructuredData", None) or None,
+                Version=1,
+                Device=__device_id(),
+            )
+            row_id = row.get("RecordId", None) or row.get("Id", None)
+            if not isinstance(row_id, str) or row_id == "":
+                row_id = None
+            key = __import_key(record)
+            if key in index:
+                counts["Duplicates"] += 1
+                if row_id is not None:
+                    row_ids[row_id] = index[key]
+                continue
+
+            # Keep the row's ID if it's free, and otherwise give it a new one.
+            record_id = row_id
+            if record_id is None or record_id in state["Records"] or record_id in imported:
+                record_id = __generate_id(state)
+                while record_id in imported:
+                    record_id = __generate_id(state)
+            index[key] = record_id
+            if row_id is not None:
+                row_ids[row_id] = record_id
+            if row.get("Interruptions", None):
+                record["Interruptions"] = row["Interruptions"]
+            imported[record_id] = record
+            counts["Imported"] += 1
+    finally:
+        if infile is not sys.stdin:
+            infile.close()
+
+    # Now that every row has its ID, references to other rows are rewritten to the IDs they were
+    # imported as. Interruptions can only be kept if the records they refer to made it into the
+    # ledger, either in this import or before it.
+    for record_id, record in imported.items():
+        if "Interruptions" in record:
+            record["Interruptions"] = [
+                dict(i, Id=row_ids.get(i["Id"], i["Id"])) for i in record["Interruptions"]
+                if isinstance(i, dict) and isinstance(i.get("Id", None), str) and (
+                    i["Id"] in row_ids or i["Id"] in state["Records"])
+            ]
+
+    __write_output(counts, pargs, config, "Import", outfile=outfile)
+    if pargs.dryrun:
+        if outfile == sys.stdout:
+            sys.exit(127)
+        else:
+            return None
+
+    state["Records"].update(imported)
+    return None if imported == dict() else dict(OldImage=None, NewImage=imported)
+
+
 def __check_tag_filter(tags, taglist):
     ret = (tags == taglist or list(set(tags).intersection(set(taglist))) != [])
     return ret
@@ -768,12 +2224,41 @@ def __check_tag_filter(tags, taglist):
 
 def __check_timespec_filter(timestamp, timespeclist):
     for timespec in timespeclist:
-        dto = __parse_time(timespec["Timespec"])
-        if eval(repr(timestamp) + timespec["Condition"] + repr(dto)):
+        if "Timestamp" in timespec:
+            dto = timespec["Timestamp"]
+        else:
+            dto = __parse_time(timespec["Timespec"])
+        if TIMESPEC_CONDITIONS[timespec["Condition"]](timestamp, dto):
             return True
     return False
 
 
+def resolve_filters(filters):
+    """
+    Return a copy of the filters with every timespec condition resolved to an absolute timestamp,
+    so that relative timespecs are parsed once per query rather than once per record, and so that
+    two queries selecting the same records compare equal.
+    """
+    resolved = list()
+    for sieve in filters:
+        sieve = dict(sieve)
+        for key in ["StartTime", "EndTime"]:
+            for timespec in sieve.get(key, list()):
+                if timespec["Condition"] not in TIMESPEC_CONDITIONS:
+                    __fail(
+                        8, "Unknown timespec filter condition \"%s\"." %
+                        timespec["Condition"])
+            if key in sieve:
+                sieve[key] = [
+                    dict(timespec,
+                         Timestamp=__parse_time(timespec["Timespec"]))
+                    if "Timestamp" not in timespec else timespec
+                    for timespec in sieve[key]
+                ]
+        resolved.append(sieve)
+    return resolved
+
+
 def __check_regex_filter(stringval, regexlist):
     import re
     if stringval is None:
@@ -784,7 +2269,32 @@ def __check_regex_filter(stringval, regexlist):
     return False
 
 
+def select_records(state, ids, filters):
+    """
+    Return the records with the given IDs (or every record, if no IDs are given) that match every one
+    of the filters, where a filter matches a record if any of its conditions do.
+    """
+    if ids != []:
+        records = {
+            record_id: state["Records"][record_id]
+            for record_id in ids if record_id in state["Records"]
+        }
+    else:
+        records = state["Records"]
+    for sieve in resolve_filters(filters):
+        records = __filter_records(sieve, records)
+    return records
+
+
 def __filter_records(sieve, records):
+    return {
+        record_id: record
+        for record_id, record in records.items()
+        if __record_matches(sieve, record)
+    }
+
+
+def __record_matches(sieve, record):
     filters = {
         "Tags": __check_tag_filter,
         "StartTime": __check_timespec_filter,
@@ -793,13 +2303,115 @@ def __filter_records(sieve, records):
         "Detail": __check_regex_filter
     }
 
-    results = dict()
-    for record_id, record in records.items():
-        for k, v in filters.items():
-            if k in record and k in sieve and v(record[k], sieve[k]):
-                results[record_id] = record
+    for k, v in filters.items():
+        if k in record and k in sieve and v(record[k], sieve[k]):
+            return True
+    return False
 
-    return results
+
+def __sort_entries(records, sort_by):
+    # The (sort key, ID) pair of each record. The ID breaks ties, so every record has a distinct
+    # position that a cursor can refer to.
+    try:
+        return [(rid if sort_by == "ID" else record[sort_by], rid)
+                for rid, record in records.items()]
+    except KeyError as e:
+        __fail(12, "Error sorting log output. %s" % repr(e))
+
+
+def sort_index(records, sort_by):
+    """
+    Return the (sort key, ID) pairs of the records in sorted order, which is the order that pages of
+    `tt ls` output are taken from.
+    """
+    try:
+        return sorted(__sort_entries(records, sort_by))
+    except TypeError as e:
+        __fail(12, "Error sorting log output. %s" % repr(e))
+
+
+def __encode_cursor(position):
+    return base64.urlsafe_b64encode(
+        json.dumps(list(position)).encode("utf-8")).decode("ascii")
+
+
+def __decode_cursor(cursor):
+    try:
+        sort_value, rid = json.loads(
+            base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8"))
+        return (sort_value, rid)
+    except (ValueError, TypeError, UnicodeError):
+        __fail(12, "Invalid page cursor \"%s\"." % cursor)
+
+
+def __page_records(state, pargs, index=None):
+    """
+    Select a page of up to --limit records matching the ID and filter options, seeking to the
+    --after and --before cursors instead of filtering and sorting the whole ledger. Returns the
+    page, in sorted order, along with the cursors of the neighbouring pages, which are None where
+    there is no neighbouring page.
+
+    Given a sorted index of the ledger, such as the one the server keeps between requests, pages
+    are found by bisecting it. Otherwise, each record is compared with the cursors, and only the
+    records that make up the page are sorted.
+    """
+    # As with the full listing, filters are ignored when specific IDs are asked for.
+    wanted = set(pargs.id) if pargs.id != [] else None
+    sieves = resolve_filters(pargs.filter) if wanted is None else list()
+    limit = pargs.limit if pargs.limit is not None else len(state["Records"])
+    if limit < 1:
+        __fail(12, "The page size must be at least 1.")
+    after = None if pargs.after is None else __decode_cursor(pargs.after)
+    before = None if pargs.before is None else __decode_cursor(pargs.before)
+
+    def selected(rid):
+        return (wanted is None or rid in wanted) and all(
+            __record_matches(sieve, state["Records"][rid]) for sieve in sieves)
+
+    # With only a --before cursor, the page is the one immediately preceding it, so walk backwards.
+    backwards = before is not None and after is None
+    # One entry more than the page holds is found, to tell whether there's a page beyond it.
+    if index is None:
+        try:
+            candidates = [
+                entry for entry in __sort_entries(state["Records"], pargs.sort_by)
+                if (after is None or entry > after) and (before is None or entry < before)
+            ]
+        except TypeError:
+            __fail(12, "The page cursor doesn't belong to a listing sorted by %s." %
+                   pargs.sort_by)
+        try:
+            entries = (heapq.nlargest if backwards else heapq.nsmallest)(
+                limit + 1, (entry for entry in candidates if selected(entry[1])))
+        except TypeError as e:
+            __fail(12, "Error sorting log output. %s" % repr(e))
+    else:
+        try:
+            start = 0 if after is None else bisect_right(index, after)
+            end = len(index) if before is None else bisect_left(index, before)
+        except TypeError:
+            __fail(12, "The page cursor doesn't belong to a listing sorted by %s." %
+                   pargs.sort_by)
+        positions = range(end - 1, start - 1, -1) if backwards else range(start, end)
+        entries = list()
+        for position in positions:
+            if selected(index[position][1]):
+                entries.append(index[position])
+                if len(entries) > limit:
+                    break
+
+    more = len(entries) > limit
+    entries = entries[:limit]
+    if backwards:
+        entries.reverse()
+
+    cursors = dict(Previous=None, Next=None)
+    if entries != []:
+        if more if backwards else after is not None:
+            cursors["Previous"] = __encode_cursor(entries[0])
+        if backwards or more or before is not None:
+            cursors["Next"] = __encode_cursor(entries[-1])
+    return [rid for _, rid in entries], cursors
 
 
 def __timestamp_to_iso(timestamp):
@@ -874,15 +2486,21 @@ def cmd_ls(pargs, state, config, outfile=sys.stdout):
     if pargs.pos_id is not None:
         pargs.id.append(pargs.pos_id)
 
-    if pargs.id != []:
-        results = {
-            rid: copy.deepcopy(state["Records"].get(rid, None))
-            for rid in pargs.id if rid in state["Records"]
-        }
+    if getattr(pargs, "ledger", []) != []:
+        # The records selected from each ledger are listed as though they were all in one.
+        state = __load_ledgers(pargs)
+
+    if pargs.limit is not None or pargs.after is not None or pargs.before is not None:
+        if pargs.last is not None:
+            __fail(12, "Pages can't be combined with selecting the last N records.")
+        page, pargs.page_cursors = __page_records(
+            state, pargs, getattr(pargs, "sort_index", None))
+        results = {rid: copy.deepcopy(state["Records"][rid]) for rid in page}
     else:
-        results = copy.deepcopy(state["Records"])
-        for sieve in pargs.filter:
-            results = __filter_records(sieve, results)
+        # Records selected by ID aren't filtered.
+        results = copy.deepcopy(
+            select_records(state, pargs.id,
+                           pargs.filter if pargs.id == [] else []))
 
     # Now, loop through to find the smallest set containing all of the specified records
     # and any of their referenced records (i.e. interruptions)
@@ -927,8 +2545,7 @@ def cmd_ls(pargs, state, config, outfile=sys.stdout):
                      if not result.get("__Hidden", False)
                  ])
     except Exception as e:
-        print("Error sorting log output.", repr(e), file=sys.stderr)
-        sys.exit(12)
+        __fail(12, "Error sorting log output. %s" % repr(e))
 
     if pargs.csv:
         __csv_format(results_list, state["Records"], pargs, outfile)
@@ -943,10 +2560,526 @@ def cmd_ls(pargs, state, config, outfile=sys.stdout):
     return None
 
 
+def __ledger_name(dotdir):
+    # Ledgers are named for their directory, or for the directory holding it if that's a .litt.
+    path = os.path.normpath(os.path.abspath(dotdir))
+    return basename(os.path.dirname(path)) if basename(path) == ".litt" else basename(path)
+
+
+def __ledger_records(name, dotdir, ids, filters):
+    """
+    Select records from the ledger in the given dotdirectory as `tt ls` would, returning the IDs
+    of the selected records, and the records along with any interruptions they refer to, with their
+    IDs qualified by the name of the ledger. This is run in a worker process by `tt ls --ledger`.
+    """
+    state = __read_ledger(None, dotdir)
+    selected = select_records(state, ids, filters if ids == [] else [])
+
+    records = dict()
+    pending = list(selected)
+    while pending != []:
+        record_id = pending.pop()
+        if record_id in records or record_id not in state["Records"]:
+            continue
+        records[record_id] = state["Records"][record_id]
+        pending.extend(i["Id"] for i in records[record_id].get("Interruptions", []))
+
+    qualified = dict()
+    for record_id, record in records.items():
+        if "Interruptions" in record:
+            record = dict(record,
+                          Interruptions=[
+                              dict(i, Id="%s:%s" % (name, i["Id"]))
+                              for i in record["Interruptions"]
+                          ])
+        qualified["%s:%s" % (name, record_id)] = record
+    return ["%s:%s" % (name, record_id) for record_id in selected], qualified
+
+
+def __load_ledgers(pargs):
+    """
+    Load and select records from every ledger given to `tt ls --ledger`, in parallel, returning a
+    state holding all of them under IDs qualified by the name of their ledger. Selecting by ID
+    selects the records with the qualified IDs given, and the records with any unqualified ID given
+    in every ledger.
+    """
+    import glob
+    from concurrent.futures import ProcessPoolExecutor
+
+    dotdirs = list()
+    for pattern in pargs.ledger:
+        matches = sorted(glob.glob(os.path.expanduser(pattern)))
+        if matches == []:
+            __fail(17, "No ledger found at %s." % pattern)
+        dotdirs += [path if isdir(path) else os.path.dirname(path) for path in matches]
+
+    ledgers = dict()
+    for dotdir in dotdirs:
+        name = __ledger_name(dotdir)
+        if name in ledgers and os.path.abspath(ledgers[name]) != os.path.abspath(dotdir):
+            __fail(17, "The ledgers in %s and %s are both named %s." %
+                   (ledgers[name], dotdir, name))
+        ledgers[name] = dotdir
+
+    # Filters are resolved once, here, so that relative timespecs mean the same in every ledger.
+    filters = resolve_filters(pargs.filter)
+    jobs = list()
+    for name, dotdir in sorted(ledgers.items()):
+        ids = [i.split(":", 1)[1] for i in pargs.id if i.startswith(name + ":")
+               ] + [i for i in pargs.id if ":" not in i]
+        if pargs.id == [] or ids != []:
+            jobs.append((name, dotdir, ids, filters))
+
+    try:
+        if len(jobs) < 2:
+            results = [__ledger_records(*job) for job in jobs]
+        else:
+            with ProcessPoolExecutor(max_workers=min(len(jobs), os.cpu_count() or 1)) as pool:
+                results = list(pool.map(__ledger_records, *zip(*jobs)))
+    except (OSError, ValueError) as exc:
+        __fail(17, "Couldn't read a ledger: %s" % exc)
+
+    state = dict(Records=dict())
+    selected = list()
+    for selected_ids, records in results:
+        selected += selected_ids
+        state["Records"].update(records)
+    pargs.filter = filters
+    if pargs.id != []:
+        pargs.id = selected
+    return state
+
+
+def cmd_perf(pargs, state, config, outfile=sys.stdout):
+    """
+    Summarize the latency percentiles recorded in the performance log, per command and per hook,
+    optionally bucketed by day or week to expose latency creeping up as the ledger grows.
+    """
+    from datetime import datetime
+    since = None if pargs.since is None else __parse_time(pargs.since)
+
+    def period(timestamp):
+        if pargs.by == "day":
+            return datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d")
+        elif pargs.by == "week":
+            return datetime.fromtimestamp(timestamp).strftime("%G-W%V")
+        return "all"
+
+    samples = dict()
+    for record in __read_perf_records():
+        if since is not None and record["Time"] < since:
+            continue
+        if pargs.perf_command != [] and record[
+                "Command"] not in pargs.perf_command:
+            continue
+        bucket = period(record["Time"])
+        command = "%s:%s" % (record["Source"], record["Command"])
+        samples.setdefault(("Command", command, bucket), list()).append(
+            (record["Total"], record["LedgerRecords"]))
+        for hook in record["Hooks"]:
+            samples.setdefault(("Hook", hook["Hook"], bucket), list()).append(
+                (hook["Duration"], record["LedgerRecords"]))
+        if pargs.phases:
+            for phase, duration in record["Phases"].items():
+                samples.setdefault(("Phase", "%s:%s" % (command, phase),
+                                    bucket), list()).append(
+                                        (duration, record["LedgerRecords"]))
+
+    summary = list()
+    for (kind, name, bucket), values in sorted(samples.items()):
+        durations = sorted([v[0] for v in values])
+        ledger_sizes = [v[1] for v in values if v[1] is not None]
+        summary.append(
+            dict(Kind=kind,
+                 Name=name,
+                 Period=bucket,
+                 Count=len(durations),
+                 P50Ms=round(__percentile(durations, 50) * 1000, 2),
+                 P90Ms=round(__percentile(durations, 90) * 1000, 2),
+                 P99Ms=round(__percentile(durations, 99) * 1000, 2),
+                 MaxMs=round(durations[-1] * 1000, 2),
+                 MeanLedgerRecords=(None if ledger_sizes == [] else int(
+                     sum(ledger_sizes) / len(ledger_sizes)))))
+
+    __write_output(summary, pargs, config, "Perf", outfile=outfile)
+    return None
+
+
+def cmd_changes(pargs, state, config, outfile=sys.stdout):
+    """
+    Print the changes made to the records and aliases after a given sequence number, or compact the
+    change log.
+    """
+    upto = state.get("Sequence", 0)
+    if pargs.compact:
+        before, after = __compact_changes(upto)
+        pruned = __prune_tombstones(state, upto)
+        print("Compacted the change log from %d to %d changes, and pruned %d tombstones." %
+              (before, after, pruned),
+              file=sys.stderr)
+    else:
+        if pargs.limit is not None and pargs.limit < 1:
+            __fail(12, "The number of changes to list must be at least 1.")
+        __write_output(__read_changes(pargs.since, upto, pargs.limit),
+                       pargs,
+                       config,
+                       "Changes",
+                       outfile=outfile)
+    return None
+
+
+def cmd_sync(pargs, state, config, outfile=sys.stdout):
+    """
+    Exchange changes with other replicas of the ledger through shared directories and peers, and
+    merge the changes received into the ledger.
+    """
+    if pargs.directory == [] and pargs.peer == []:
+        __fail(15, "At least one of --dir and --peer must be given.")
+
+    # The cursors are only saved once the merged changes are committed, so that a failure repeats
+    # the exchange, which is harmless as merging a change twice leaves the same result.
+    cursors = __load_sync_cursors()
+    received = list()
+    sent = 0
+    for path in pargs.directory:
+        changes, exported = __sync_directory(path, state, cursors)
+        received += changes
+        sent += exported
+    for url in pargs.peer:
+        try:
+            changes, pushed = __sync_peer(url, pargs.preshared_key, state, cursors)
+        except OSError as exc:
+            __fail(15, "Unable to sync with %s: %s" % (url, exc))
+        received += changes
+        sent += pushed
+    pargs.sync_cursors = cursors
+
+    images = apply_changes(state, received)
+    __write_output(
+        dict(Sent=sent,
+             Received=len(received),
+             Merged=0 if images is None else len(images["NewImage"])),
+        pargs,
+        config,
+        "Sync",
+        outfile=outfile)
+    return images
+
+
+def cmd_exec(pargs, hooks, timings=None):
+    """
+    Run each command line of a script in turn, stopping at the first that fails, and commit their
+    changes in one transaction once they've all succeeded (or each in its own, with --autocommit).
+    Returns the number of bytes written.
+    """
+    ledger = Ledger()
+    with open(pargs.file, "r") if pargs.file != "-" else nullcontext(
+            sys.stdin) as infile:
+        lines = infile.read().splitlines()
+
+    # Every line is parsed before any is run, so that a script with a mistake runs none of it.
+    script = list()
+    for lineno, line in enumerate(lines, 1):
+        argv = shlex.split(line, comments=True)
+        if argv != [] and basename(argv[0]) in ["tt", "tt.py"]:
+            argv = argv[1:]
+        if argv == []:
+            continue
+        try:
+            line_pargs = ledger.parse(argv)
+            if line_pargs.command in UNSCRIPTABLE_COMMANDS:
+                __fail(16,
+                       "tt %s can't be run from a script." % line_pargs.command)
+        except (CommandError, SystemExit):
+            print("Stopped at line %d of %s: %s" % (lineno, pargs.file, line),
+                  file=sys.stderr)
+            raise
+        script.append((lineno, line, line_pargs))
+
+    transactions = [[step] for step in script] if pargs.autocommit else [script]
+    written = 0
+    for steps in transactions:
+        commands = list(
+            dict.fromkeys(line_pargs.command or "base" for _, _, line_pargs in steps))
+        # The output of the lines is held back until they're committed, so that nothing is printed
+        # for changes, such as a new record's ID, that a later failure rolls back.
+        output = StringIO()
+        with ledger.transaction(timings, hooks, commands) as txn:
+            for lineno, line, line_pargs in steps:
+                try:
+                    with timed_phase(timings, "command"):
+                        txn.execute(line_pargs, output)
+                except (CommandError, SystemExit):
+                    print("Stopped at line %d of %s: %s" % (lineno, pargs.file, line),
+                          file=sys.stderr)
+                    raise
+        sys.stdout.write(output.getvalue())
+        written += txn.written
+    return written
+
+
+def cmd_hooks(pargs, _, config, outfile=sys.stdout):
+    """
+    Inspect or deliver the payloads queued in the outbox for asynchronous hooks.
+    """
+    if pargs.hooks_command == "drain":
+        os.makedirs(__outbox_dir(), exist_ok=True)
+        if pargs.background:
+            # Keep delivering until the outbox is empty or only holds entries that have exhausted
+            # their retries. Re-check the outbox after releasing the lock, in case an entry was
+            # queued by a process whose worker found the lock still held.
+            #
+            # Only one background worker runs at a time, but the lock over each delivery pass is
+            # released while backing off so that `tt hooks drain` isn't kept waiting.
+            while __outbox_entries() != []:
+                with __file_lock(pathjoin(__outbox_dir(), ".worker.lock"),
+                                 blocking=False) as acquired:
+                    if not acquired:
+                        return None
+                    while True:
+                        with __file_lock(pathjoin(__outbox_dir(), ".lock")):
+                            remaining, next_attempt = __drain_outbox(False)
+                        if remaining == 0 or next_attempt is None:
+                            break
+                        # Wake up at least every OUTBOX_POLL_INTERVAL so that payloads queued
+                        # meanwhile for other hooks aren't held up by this backoff.
+                        time.sleep(
+                            min(max(next_attempt - time.time(), 0),
+                                OUTBOX_POLL_INTERVAL))
+                if remaining != 0:
+                    # Only entries that have exhausted their retries are left, and those wait
+                    # for an explicit `tt hooks drain`.
+                    break
+        else:
+            with __file_lock(pathjoin(__outbox_dir(), ".lock")):
+                remaining, _ = __drain_outbox(True)
+            if remaining != 0:
+                __fail(
+                    10, "%d queued hook payload(s) could not be delivered." %
+                    remaining)
+    else:
+        status = list()
+        for name in __outbox_entries():
+            with open(pathjoin(__outbox_dir(), name), "r") as fp:
+                entry = json.loads(fp.read())
+            status.append(
+                dict(Entry=name[:-len(".json")],
+                     Event=entry["Event"],
+                     Created=entry["Created"],
+                     Pending=[
+                         dict(Hook=basename(hookfile),
+                              Attempts=delivery["Attempts"],
+                              NextAttempt=delivery["NextAttempt"],
+                              LastError=delivery["LastError"])
+                         for hookfile, delivery in sorted(
+                             entry["Pending"].items())
+                     ]))
+        __write_output(status, pargs, config, "Outbox", outfile=outfile)
+    return None
+
+
 def cmd_serve(pargs, state, config):
     import tt_serve
-    server = tt_serve.create_server(pargs.preshared_key)
-    server.run(port=pargs.port)
+    server = tt_serve.create_server(pargs.preshared_key,
+                                    commit_window=pargs.commit_window,
+                                    commit_batch=pargs.commit_batch)
+    if pargs.threads is None:
+        server.run(port=pargs.port)
+    else:
+        tt_serve.serve_pooled(server, pargs.port, pargs.threads)
+
+
+# The commands that only read the ledger (or, for serve, only change it through the server), and so
+# run without the ledger lock. None is `tt` itself.
+READ_ONLY_COMMANDS = [None, "ls", "perf", "changes", "serve"]
+
+# The commands that can't be run in a `tt exec` script. tt config writes config.json as soon as it
+# runs, rather than when the script is committed.
+UNSCRIPTABLE_COMMANDS = ["config", "exec", "hooks", "serve", "sync"]
+
+# The commands that can be run in a Ledger transaction, which all write their output to the file
+# they're given.
+TRANSACTION_COMMANDS = {
+    "start": cmd_start,
+    "stop": cmd_stop,
+    "sw": cmd_sw,
+    "isw": cmd_isw,
+    "cancel": cmd_cancel,
+    "interrupt": cmd_interrupt,
+    "resume": cmd_resume,
+    "track": cmd_track,
+    "amend": cmd_amend,
+    "rm": cmd_rm,
+    "import": cmd_import,
+    "alias": lambda pargs, state, config, _: cmd_alias(pargs, state, config)
+}
+
+
+class Ledger(object):
+    """
+    The ledger, opened for use from Python. The state is loaded once, and only loaded again when
+    the ledger or config is changed by anything else, which costs a stat() of each to check.
+    Changes are made in transactions, each of which is committed in a single write with a single
+    round of commit hooks:
+
+        ledger = tt.Ledger()
+        with ledger.transaction() as txn:
+            record_id = txn.run("track", "-s", "9am", "-e", "10am", "Planning")
+            txn.run("amend", id=record_id, tag=["Meetings"])
+        meetings = ledger.records(filters=[{"Tags": ["Meetings"]}])
+
+    Queries return copies of what they find, which can be changed freely.
+    """
+    def __init__(self):
+        if not check_dotfile():
+            init_dotfiles()
+        self.lock = threading.Lock()
+        self.signature = None
+        self.state = None
+        self.config = None
+        self.parser = None
+
+    def snapshot(self, timings=None):
+        """
+        Return the signature, state and config of the latest snapshot of the ledger, first taking a
+        new snapshot if the ledger or config have changed. A snapshot is never modified once it has
+        been taken, so must not be modified by the caller either.
+        """
+        signature = snapshot_signature()
+        with self.lock:
+            if signature != self.signature:
+                self.state, self.config = load_state(timings)
+                self.signature = signature
+            return self.signature, self.state, self.config
+
+    def records(self, ids=None, filters=None):
+        """
+        Return the records with the given IDs (or every record, if none are given) that match every
+        filter, given in the format of `tt ls --filter`, keyed on ID.
+        """
+        _, state, _ = self.snapshot()
+        return copy.deepcopy(
+            select_records(state, list(ids or []), list(filters or [])))
+
+    def record(self, record_id):
+        """
+        Return the record with the given ID, or None if there isn't one.
+        """
+        return self.records([record_id]).get(record_id, None)
+
+    def aliases(self):
+        return copy.deepcopy(self.snapshot()[1]["Aliases"])
+
+    def stopwatch(self):
+        return copy.deepcopy(self.snapshot()[1]["Stopwatch"])
+
+    def interruption(self):
+        return copy.deepcopy(self.snapshot()[1]["Interruption"])
+
+    def parse(self, argv):
+        """
+        Parse a tt command line, without the leading tt.
+        """
+        if self.parser is None:
+            self.parser = build_parser()
+        return self.parser.parse_args(argv)
+
+    @contextmanager
+    def transaction(self, timings=None, hooks=None, commands=None):
+        """
+        Hold the ledger lock for the duration of the block, yielding a Transaction of changes to
+        the latest state. Once the block completes, everything changed in it is committed in a
+        single write, with one round of commit hooks for each command run, given the images of
+        everything that command changed. If the block raises, nothing is committed.
+
+        The pre_load hooks are run for each of the given commands (or as for `tt` itself, if none
+        are given) before the lock is taken, and the post_commit hooks once it has been released.
+        """
+        if hooks is None:
+            with timed_phase(timings, "load_hooks"):
+                hooks = load_hooks()
+        for command in commands or ["base"]:
+            run_hooks("pre_load", hooks, None, timings, command)
+        with ledger_lock(timings):
+            _, base, config = self.snapshot(timings)
+            txn = Transaction(self, base, config, hooks)
+            yield txn
+
+            images_by_command = {
+                command: merge_images(images_list)
+                for command, images_list in txn.images_by_command.items()
+            }
+            if images_by_command != dict():
+                txn.written = write_group(txn.state, hooks, images_by_command,
+                                          timings, base, config)
+                with self.lock:
+                    self.signature = snapshot_signature()
+                    self.state = txn.state
+        if images_by_command != dict():
+            finish_group(hooks, images_by_command, txn.written, timings)
+
+
+class Transaction(object):
+    """
+    The changes made in a Ledger transaction. Each change is made to a fork of the state left by
+    the last, so one that fails leaves the state of the transaction as it was.
+    """
+    def __init__(self, ledger, state, config, hooks):
+        self.ledger = ledger
+        self.state = state
+        self.config = config
+        self.hooks = hooks
+        self.images_by_command = dict()
+        # The number of bytes written when the transaction was committed.
+        self.written = 0
+
+    def fork(self):
+        return fork_state(self.state)
+
+    def update(self, command, state, images):
+        """
+        Make the given state, reached by running the command on a fork of the state of the
+        transaction, the state of the transaction.
+        """
+        self.state = state
+        self.images_by_command.setdefault(command, list()).append(images)
+
+    def execute(self, pargs, outfile=sys.stdout):
+        """
+        Run a tt command, as parsed from its command line, writing its output to the given file. A
+        command run with --dryrun only previews what it would change, and changes nothing.
+        """
+        state = self.fork()
+        if getattr(pargs, "dryrun", False):
+            # Commands only exit after a dry run when writing to stdout, so they're given a buffer.
+            preview = StringIO()
+            dispatch(pargs, state, self.config, self.hooks, preview)
+            outfile.write(preview.getvalue())
+            return
+        images = dispatch(pargs, state, self.config, self.hooks, outfile)
+        self.update(pargs.command or "base", state, images)
+
+    def run(self, command, *argv, **arguments):
+        """
+        Run a tt command with the arguments parsed from the given command line arguments, then
+        overridden by the keyword arguments, which are named for the command's options (such as
+        start_time or tag). Returns the output of the command, or None if it had none.
+        """
+        if command not in TRANSACTION_COMMANDS:
+            raise ValueError("tt %s can't be run in a transaction." % command)
+        pargs = self.ledger.parse([command] + list(argv))
+        for key, value in arguments.items():
+            if not hasattr(pargs, key):
+                raise TypeError("tt %s has no argument %s" % (command, key))
+            setattr(pargs, key, value)
+        pargs.output_format = "json-compact"
+
+        state = self.fork()
+        output = StringIO()
+        images = TRANSACTION_COMMANDS[command](pargs, state, self.config, output)
+        if not getattr(pargs, "dryrun", False):
+            self.update(command, state, images)
+        return json.loads(output.getvalue()) if output.getvalue() != "" else None
 
 
 def __positional_argument(parser):
@@ -1055,6 +3188,17 @@ def __timespec_options(parser, start=True, end=True):
         )
 
 
+def __filter_option(parser, help_text):
+    parser.add_argument("-f",
+                        "--filter",
+                        required=False,
+                        metavar="<filter spec>",
+                        default=[],
+                        type=json.loads,
+                        action="append",
+                        help=help_text)
+
+
 def __dryrun_option(parser):
     parser.add_argument(
         "--dryrun",
@@ -1065,12 +3209,11 @@ def __dryrun_option(parser):
     )
 
 
-def __main():  # pylint: disable=R0915
-    if not check_dotfile():
-        print("Dotfiles are missing, performing first-time setup.",
-              file=sys.stderr)
-        init_dotfiles()
-
+def build_parser():  # pylint: disable=R0915
+    """
+    Build the parser for tt command lines, which parses both the command line and each line of a
+    `tt exec` script.
+    """
     ################ tt
     parser = ArgumentParser(description="""
     Track time on projects, tasks, and other items via the CLI.
@@ -1084,15 +3227,52 @@ def __main():  # pylint: disable=R0915
         help="""
     The output format to use for commands that produce output.
     """)
+    parser.add_argument(
+        "--profile",
+        required=False,
+        default=False,
+        action="store_true",
+        help="""
+    Print a breakdown of the wall-clock time spent in each phase of the command, and in each hook
+    executable, to stderr.
+    """)
+    parser.add_argument(
+        "--profile-stats",
+        required=False,
+        default=None,
+        metavar="<path>",
+        help="""
+    Profile the command with cProfile, and save the statistics to the given path in the pstats
+    format. Implies --profile.
+    """)
+    parser.add_argument(
+        "--profile-memory",
+        required=False,
+        default=False,
+        action="store_true",
+        help="""
+    Trace memory allocations with tracemalloc, and report the peak traced memory. Implies
+    --profile.
+    """)
 
     subparsers = parser.add_subparsers(
         title="Supported time tracking commands", dest="command")
 
     ################ tt config
-    subparsers.add_parser("config",
-                          help="""
+    cmd = subparsers.add_parser("config",
+                                help="""
     Set or dump persistent configuration values.
     """)
+    cmd.add_argument(
+        "--storage-layout",
+        required=False,
+        default=None,
+        choices=STORAGE_LAYOUTS,
+        help=
+        """The layout to write the ledger in: "json" pretty-prints it, and "lines" puts each
+        record and alias on its own line, in order of ID, so that each change to the ledger changes
+        only a few lines of it (which keeps a git repository of the ledger small). The ledger is
+        rewritten in the new layout straight away.""")
 
     ################ tt sw
     cmd = subparsers.add_parser("sw",
@@ -1189,6 +3369,80 @@ def __main():  # pylint: disable=R0915
         metavar="<tag>",
         help="""List of tags to remove, if they exist, from the time record."""
     )
+    cmd.add_argument(
+        "--if-version",
+        required=False,
+        default=None,
+        type=int,
+        metavar="<version>",
+        help="""Only amend the record if it is still at the given version, failing with exit code 14
+        if it has been changed since.""")
+    __filter_option(
+        cmd,
+        """Amend every record matching the filter spec (and with the --id, if given), in the
+        format of `tt ls --filter`. Can be repeated, in which case records must match every filter.
+        With --dryrun, the records that would be amended are listed without amending them.""")
+    __dryrun_option(cmd)
+
+    ################ tt rm
+    cmd = subparsers.add_parser(
+        "rm",
+        help=
+        """Delete records, along with any of their interruptions that no other record refers to.""")
+    cmd.add_argument(
+        "-i",
+        "--id",
+        required=False,
+        default=[],
+        action="append",
+        metavar="<identifier>",
+        help="""The unique identifier of a record to delete. Can be repeated multiple times.""")
+    __filter_option(
+        cmd,
+        """Delete every record matching the filter spec (and with one of the --id values, if any
+        are given), in the format of `tt ls --filter`. Can be repeated, in which case records must
+        match every filter.""")
+    cmd.add_argument(
+        "--dryrun",
+        required=False,
+        action="store_true",
+        help="""List the records that would be deleted without deleting them.""")
+
+    ################ tt import
+    cmd = subparsers.add_parser(
+        "import",
+        help=
+        """Import records from an NDJSON or CSV file (such as `tt ls --csv` writes) in a single
+        commit, skipping any that duplicate a record already in the ledger.""")
+    cmd.add_argument(
+        "file",
+        metavar="<file>",
+        help="""The file to import, or - to read from stdin.""")
+    cmd.add_argument(
+        "-f",
+        "--format",
+        required=False,
+        default=None,
+        choices=["ndjson", "csv"],
+        help=
+        """The format of the file. Defaults to csv for files named *.csv, and ndjson otherwise.""")
+    cmd.add_argument(
+        "-t",
+        "--tag",
+        action="append",
+        required=False,
+        default=[],
+        metavar="<tag>",
+        help=
+        """Add a tag to every imported record, such as one `tt ls --csv` left out because every
+        record had it. Specify multiple times to add multiple tags.""")
+    cmd.add_argument(
+        "--skip-invalid",
+        required=False,
+        default=False,
+        action="store_true",
+        help=
+        """Skip rows that can't be imported, rather than failing without importing any.""")
     __dryrun_option(cmd)
 
     ################ tt alias
@@ -1234,6 +3488,29 @@ def __main():  # pylint: disable=R0915
         help=
         """Only display the last N entries, as sorted. A negative value will take the first N entries instead of the last"""
     )
+    cmd.add_argument(
+        "-l",
+        "--limit",
+        required=False,
+        metavar="<N>",
+        default=None,
+        type=int,
+        help="""Only display a page of at most N entries, as sorted. The cursors of the previous and
+        next pages, if there are any, are printed to stderr.""")
+    cmd.add_argument(
+        "-a",
+        "--after",
+        required=False,
+        metavar="<cursor>",
+        default=None,
+        help="""Only display entries after the given page cursor, as sorted.""")
+    cmd.add_argument(
+        "-b",
+        "--before",
+        required=False,
+        metavar="<cursor>",
+        default=None,
+        help="""Only display entries before the given page cursor, as sorted.""")
     cmd.add_argument(
         "-i",
         "--id",
@@ -1285,8 +3562,149 @@ def __main():  # pylint: disable=R0915
                      default=False,
                      action="store_true",
                      help="""Exclude the detailed text field in the output.""")
+    cmd.add_argument(
+        "-L",
+        "--ledger",
+        required=False,
+        default=[],
+        action="append",
+        metavar="<path or glob>",
+        help=
+        """List the records of the ledger in the given LITT directory (or the given events.json)
+        instead of your own. Can be repeated, and globs are expanded, to list the records of many
+        ledgers together, with each record's ID prefixed by the name of the directory its ledger is
+        in (or the directory above, for a .litt directory) and a colon. The ledgers are read in
+        parallel.""")
     __dryrun_option(cmd)
 
+    ################ tt perf
+    cmd = subparsers.add_parser(
+        "perf",
+        help=
+        """Summarize the latency percentiles of past invocations, per command and per hook.""")
+    cmd.add_argument(
+        "-c",
+        "--command",
+        required=False,
+        default=[],
+        dest="perf_command",
+        metavar="<command>",
+        action="append",
+        help=
+        """Only summarize invocations of the given command. Can be repeated multiple times.""")
+    cmd.add_argument(
+        "-b",
+        "--by",
+        required=False,
+        default="all",
+        choices=["all", "day", "week"],
+        help="""Bucket the summary by the day or week the invocations happened in.""")
+    cmd.add_argument(
+        "-s",
+        "--since",
+        required=False,
+        default=None,
+        metavar="<timespec>",
+        help="""Only summarize invocations that happened after the given time.""")
+    cmd.add_argument(
+        "-p",
+        "--phases",
+        required=False,
+        default=False,
+        action="store_true",
+        help="""Include a summary of each phase (load, parse, write, ...) of each command.""")
+
+    ################ tt changes
+    cmd = subparsers.add_parser(
+        "changes",
+        help=
+        """List the changes made to records and aliases, each with the image before and after it,
+        in the order they were made.""")
+    cmd.add_argument(
+        "-s",
+        "--since",
+        required=False,
+        default=0,
+        type=int,
+        metavar="<sequence>",
+        help=
+        """Only list the changes after the one with the given sequence number. To resume from where
+        a previous listing ended, give the sequence number of its last change.""")
+    cmd.add_argument(
+        "-l",
+        "--limit",
+        required=False,
+        default=None,
+        type=int,
+        metavar="<N>",
+        help="""List at most this many changes.""")
+    cmd.add_argument(
+        "--compact",
+        required=False,
+        default=False,
+        action="store_true",
+        help=
+        """Compact the change log, keeping only the latest change to each record and alias, and
+        prune the tombstones of deletions already sent to every replica synced with.""")
+
+    ################ tt sync
+    cmd = subparsers.add_parser(
+        "sync",
+        help=
+        """Exchange changes to records and aliases with other replicas of the ledger, and merge
+        in the changes they made.""")
+    cmd.add_argument(
+        "-d",
+        "--dir",
+        required=False,
+        default=[],
+        action="append",
+        dest="directory",
+        metavar="<path>",
+        help=
+        """A directory shared between replicas (such as a synced or network folder) through which
+        to exchange changes. Can be repeated multiple times.""")
+    cmd.add_argument(
+        "-p",
+        "--peer",
+        required=False,
+        default=[],
+        action="append",
+        metavar="<url>",
+        help=
+        """The URL of a `tt serve` of another replica to exchange changes with. Can be repeated
+        multiple times.""")
+    cmd.add_argument(
+        "-k",
+        "--preshared-key",
+        required=False,
+        default=None,
+        type=str,
+        help="""Pre-shared key to send to the peers, as `Authorization: Bearer <key>`.""")
+
+    ################ tt hooks
+    cmd = subparsers.add_parser(
+        "hooks",
+        help="""Inspect or deliver the payloads queued for asynchronous hooks.""")
+    hooks_subparsers = cmd.add_subparsers(title="Hook outbox commands",
+                                          dest="hooks_command")
+    hooks_subparsers.add_parser(
+        "status",
+        help="""List the queued payloads that have not yet been delivered to every hook.""")
+    hooks_cmd = hooks_subparsers.add_parser(
+        "drain",
+        help=
+        """Deliver every queued payload now, ignoring any retry backoff, and exit non-zero if any
+        could not be delivered.""")
+    hooks_cmd.add_argument(
+        "--background",
+        required=False,
+        default=False,
+        action="store_true",
+        help=
+        """Run as the background worker, retrying failed deliveries with backoff until the
+        outbox is empty. This is started automatically after each commit.""")
+
     ################ tt serve
     cmd = subparsers.add_parser(
         "serve",
@@ -1307,54 +3725,190 @@ def __main():  # pylint: disable=R0915
         help=
         """Pre-shared key string to use to ensure that clients are authenticated. If not specified, then the API is unauthenticated. If provided, then this must be provided as an Authentication HTTP header, as `Bearer ${PreSharedKey}`"""
     )
+    cmd.add_argument(
+        "--commit-window",
+        required=False,
+        default=None,
+        type=float,
+        metavar="<ms>",
+        help=
+        """How long, in milliseconds, the writer waits for more changes to arrive before committing
+        the ones it has in a single write. The default is 2ms, and 0 only groups the changes that
+        are already waiting.""")
+    cmd.add_argument(
+        "--commit-batch",
+        required=False,
+        default=None,
+        type=int,
+        metavar="<N>",
+        help="""The most changes committed in a single write. The default is 64.""")
+    cmd.add_argument(
+        "-t",
+        "--threads",
+        required=False,
+        default=None,
+        type=int,
+        metavar="<N>",
+        help=
+        """Serve with the standard library's WSGI server, handling up to N requests concurrently,
+        instead of Flask's development server.""")
+
+    ################ tt exec
+    cmd = subparsers.add_parser(
+        "exec",
+        help=
+        """Run a script of tt commands, one per line, against the ledger in a single process.""")
+    cmd.add_argument(
+        "file",
+        metavar="<path|->",
+        help=
+        """The script to run, or - to read it from stdin. Each line is a tt command line, optionally
+        starting with `tt`, and blank lines and # comments are skipped.""")
+    cmd.add_argument(
+        "--autocommit",
+        required=False,
+        default=False,
+        action="store_true",
+        help=
+        """Commit the changes of each command as soon as it succeeds, rather than committing the
+        changes of the whole script once it has all succeeded.""")
+
+    return parser
+
 
-    pargs = parser.parse_args()
+def __main():
+    if not check_dotfile():
+        print("Dotfiles are missing, performing first-time setup.",
+              file=sys.stderr)
+        init_dotfiles()
 
-    hooks = load_hooks()
-    run_hooks("pre_load", hooks, None)
+    pargs = build_parser().parse_args()
 
-    state, config = __load_state()
+    timings = new_timings(pargs.command or "base")
+    timings["Phases"]["imports"] = __IMPORTS_DONE - __IMPORT_START
+    profiler = __start_profiling(pargs)
+    try:
+        __run_command(pargs, timings)
+    except CommandError as exc:
+        timings["ExitCode"] = exc.code
+        sys.exit(exc.code)
+    except SystemExit as exc:
+        timings["ExitCode"] = exc.code
+        raise
+    finally:
+        __finish_profiling(pargs, profiler, timings)
+        timings["Total"] = time.perf_counter() - __IMPORT_START
+        if pargs.profile or pargs.profile_stats is not None or pargs.profile_memory:
+            __print_profile(timings)
+        if pargs.command != "serve":
+            append_perf_record(timings, "cli")
+
+
+def __run_command(pargs, timings):
+    if pargs.command == "hooks":
+        # Managing the hook outbox neither reads nor writes the ledger, so skip loading it, the
+        # pre_load hooks, and the commit entirely.
+        cmd_hooks(pargs, None, __load_config(timings))
+        return
 
-    # When records are added, edited, or removed, the images (OldImage and NewImage) are kept
-    # for passing into the hooks.
-    images = None
+    with timed_phase(timings, "load_hooks"):
+        hooks = load_hooks()
+
+    if pargs.command == "exec":
+        # Scripts run in transactions, which run the hooks of the commands in them.
+        timings["BytesWritten"] = cmd_exec(pargs, hooks, timings)
+        return
+
+    command = pargs.command or "base"
+    run_hooks("pre_load", hooks, None, timings, command)
+
+    # Compacting the change log rewrites it, so takes the lock like any change to the ledger.
+    if pargs.command in READ_ONLY_COMMANDS and not getattr(pargs, "compact", False):
+        # The ledger is only ever replaced whole, so reading it doesn't need the ledger lock. The
+        # server takes the lock for each change it makes, so can't hold it while serving either.
+        state, config = load_state(timings)
+        timings["LedgerRecords"] = len(state["Records"])
+        with timed_phase(timings, "command"):
+            dispatch(pargs, state, config, hooks)
+        for hookevent in ["pre_commit", "post_commit"]:
+            run_hooks(hookevent, hooks, None, timings, command)
+        return
+
+    # The lock is held from loading the ledger until it has been written, and no longer, so that
+    # the post_commit hooks can run tt.
+    with ledger_lock(timings):
+        state, config = load_state(timings)
+        timings["LedgerRecords"] = len(state["Records"])
+
+        # The state as loaded, which the change log records the changes to.
+        base = fork_state(state)
+
+        # When records are added, edited, or removed, the images (OldImage and NewImage) are kept
+        # for passing into the hooks.
+        with timed_phase(timings, "command"):
+            images = dispatch(pargs, state, config, hooks)
+
+        timings["BytesWritten"] = write_group(state, hooks, {command: images},
+                                              timings, base, config)
+
+        if pargs.command == "sync":
+            __write_sync_cursors(pargs.sync_cursors)
 
+    finish_group(hooks, {command: images}, timings["BytesWritten"], timings)
+
+
+def dispatch(pargs, state, config, hooks, outfile=sys.stdout):
+    """
+    Run the command selected on the command line against the loaded state, returning the images of
+    any changed items.
+    """
+    images = None
     if pargs.command is None:
-        cmd_base(pargs, state, config)
+        cmd_base(pargs, state, config, outfile)
     elif pargs.command == "config":
         cmd_config(pargs, state, config, hooks)
     elif pargs.command == "alias":
         images = cmd_alias(pargs, state, config)
     elif pargs.command == "start":
-        cmd_start(pargs, state, config)
+        cmd_start(pargs, state, config, outfile)
     elif pargs.command == "stop":
-        images = cmd_stop(pargs, state, config)
+        images = cmd_stop(pargs, state, config, outfile)
     elif pargs.command == "sw":
-        images = cmd_sw(pargs, state, config)
+        images = cmd_sw(pargs, state, config, outfile)
     elif pargs.command == "isw":
-        images = cmd_isw(pargs, state, config)
+        images = cmd_isw(pargs, state, config, outfile)
     elif pargs.command == "cancel":
-        cmd_cancel(pargs, state, config)
+        cmd_cancel(pargs, state, config, outfile)
     elif pargs.command in ["i", "interrupt"]:
-        cmd_interrupt(pargs, state, config)
+        cmd_interrupt(pargs, state, config, outfile)
     elif pargs.command in ["r", "resume"]:
-        images = cmd_resume(pargs, state, config)
+        images = cmd_resume(pargs, state, config, outfile)
     elif pargs.command == "track":
-        images = cmd_track(pargs, state, config)
+        images = cmd_track(pargs, state, config, outfile)
     elif pargs.command == "amend":
-        images = cmd_amend(pargs, state, config)
+        images = cmd_amend(pargs, state, config, outfile)
+    elif pargs.command == "rm":
+        images = cmd_rm(pargs, state, config, outfile)
+    elif pargs.command == "import":
+        images = cmd_import(pargs, state, config, outfile)
     elif pargs.command == "ls":
-        cmd_ls(pargs, state, config)
+        cmd_ls(pargs, state, config, outfile)
+        # Cursors go to stderr so that they don't interfere with parsing the page itself.
+        for direction, cursor in getattr(pargs, "page_cursors", dict()).items():
+            if cursor is not None:
+                sys.stderr.write("%s page: --%s %s\n" %
+                                 (direction, "before" if direction == "Previous"
+                                  else "after", cursor))
+    elif pargs.command == "perf":
+        cmd_perf(pargs, state, config, outfile)
+    elif pargs.command == "changes":
+        cmd_changes(pargs, state, config, outfile)
+    elif pargs.command == "sync":
+        images = cmd_sync(pargs, state, config, outfile)
     elif pargs.command == "serve":
         cmd_serve(pargs, state, config)
-        # Because the state was modified out of band of this process,
-        # we need to reload it ot to ensure that this in-line __write_state()
-        # doesn't clobber it with our initially loaded state
-        state, config = __load_state()
-
-    run_hooks("pre_commit", hooks, images)
-    __write_state(state, hooks)
-    run_hooks("post_commit", hooks, images)
+
+    return images
 
 
 if __name__ == "__main__":
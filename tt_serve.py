@@ -1,9 +1,19 @@
 #!/usr/bin/env python3
 
-from flask import Flask, request
+from flask import Flask, Response, request, g, jsonify, current_app, make_response
 
+import os
+import gzip
+import hmac
 import json
-from collections import namedtuple
+import time
+import zlib
+import queue
+import hashlib
+import threading
+from collections import namedtuple, OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
 from io import StringIO
 
 import tt
@@ -14,6 +24,134 @@ POSITIONAL_ARG = ["quicktext"]
 TIMESPEC_ARGS = ["start_time", "end_time"]
 COMMIT_TIME_ARGS = ["id", "untag"]
 DRYRUN_ARG = ["dryrun"]
+PROPERTY_ARGS = ["description", "detail", "tag", "structured_data"]
+
+# Default values of every argument accepted by an operation in a batch.
+ARG_DEFAULTS = dict(output_format=None,
+                    quicktext=None,
+                    alias=None,
+                    description=None,
+                    detail=None,
+                    tag=[],
+                    structured_data=None,
+                    start_time=None,
+                    end_time=None,
+                    id=None,
+                    untag=[],
+                    dryrun=False,
+                    if_version=None,
+                    key=None)
+
+# The type of value each argument of an operation in a batch takes, besides its default. List
+# arguments are lists of strings.
+ARG_TYPES = dict(output_format=str,
+                 quicktext=str,
+                 alias=str,
+                 description=str,
+                 detail=str,
+                 tag=list,
+                 structured_data=str,
+                 start_time=str,
+                 end_time=str,
+                 id=str,
+                 untag=list,
+                 dryrun=bool,
+                 if_version=int,
+                 key=str)
+ARG_TYPE_NAMES = {
+    str: "a string",
+    list: "a list of strings",
+    bool: "true or false",
+    int: "an integer"
+}
+
+# The commands that can be run as operations in a batch, and the arguments each accepts.
+BATCH_COMMANDS = dict(
+    track=(tt.cmd_track, COMMON_ARGS + POSITIONAL_ARG + ALIAS_ARGS +
+           PROPERTY_ARGS + TIMESPEC_ARGS + COMMIT_TIME_ARGS + DRYRUN_ARG),
+    start=(tt.cmd_start, COMMON_ARGS + POSITIONAL_ARG + ALIAS_ARGS +
+           PROPERTY_ARGS + ["start_time"]),
+    stop=(tt.cmd_stop, COMMON_ARGS + POSITIONAL_ARG + ALIAS_ARGS +
+          PROPERTY_ARGS + ["end_time"] + COMMIT_TIME_ARGS),
+    interrupt=(tt.cmd_interrupt,
+               COMMON_ARGS + POSITIONAL_ARG + ALIAS_ARGS + PROPERTY_ARGS),
+    resume=(tt.cmd_resume, COMMON_ARGS + POSITIONAL_ARG + ALIAS_ARGS +
+            PROPERTY_ARGS + COMMIT_TIME_ARGS),
+    amend=(tt.cmd_amend, COMMON_ARGS + POSITIONAL_ARG + ALIAS_ARGS +
+           PROPERTY_ARGS + TIMESPEC_ARGS + COMMIT_TIME_ARGS + DRYRUN_ARG +
+           ["if_version"]),
+    alias=(lambda pargs, state, config, _: tt.cmd_alias(pargs, state, config),
+           COMMON_ARGS + ["key"] + PROPERTY_ARGS),
+)
+
+# HTTP status codes reported for the exit codes of failed commands.
+ERROR_STATUS = {6: 400, 7: 400, 8: 400, 9: 404, 10: 502, 12: 400, 14: 412, 15: 400}
+
+# Request header used to ask for per-request instrumentation. The value is a comma separated list
+# of any of "timing", "memory" (tracemalloc peak) and "stats" (a cProfile dump saved under
+# ~/.litt/profiles); any non-empty value enables timing.
+PROFILE_HEADER = "X-TT-Profile"
+
+# Number of rendered responses to read-only routes kept by the server, keyed on the snapshot of the
+# ledger they were rendered from and the request, with the least recently used evicted first.
+RESPONSE_CACHE_ENTRIES = 128
+
+# How long, in seconds, the writer waits for more changes after the first before committing them
+# together, and the most changes it commits in one write.
+COMMIT_WINDOW = 0.002
+COMMIT_BATCH = 64
+
+# The output format of responses that don't ask for one with the output_format parameter. The
+# OutputFormat configured for the CLI isn't used, as it is usually chosen for reading in a terminal.
+API_OUTPUT_FORMAT = "json-compact"
+
+# The content codings responses can be compressed with, in order of preference, and the size, in
+# bytes, below which a response is sent uncompressed as it isn't worth the time.
+COMPRESSORS = OrderedDict([("gzip", lambda data: gzip.compress(data, 6)),
+                           ("deflate", zlib.compress)])
+COMPRESS_MIN_BYTES = 1024
+
+# The metrics exposed by /metrics, with their types and descriptions, and the upper bounds, in
+# seconds, of the buckets of the latency histograms.
+METRICS = OrderedDict([
+    ("tt_requests_total", ("counter", "Requests served, by route and status code.")),
+    ("tt_request_duration_seconds",
+     ("histogram", "Time taken to serve a request, by route.")),
+    ("tt_phase_duration_seconds",
+     ("histogram",
+      "Time spent in each phase of serving a request, including reading (read), parsing "
+      "(parse), serializing (serialize), and writing (write) the ledger, and waiting for the "
+      "writer (queue_wait) and the ledger lock (lock_wait).")),
+    ("tt_hook_duration_seconds",
+     ("histogram", "Time taken to run a hook, by hook file.")),
+    ("tt_hook_runs_total",
+     ("counter", "Hook runs, by hook file and whether the hook succeeded.")),
+    ("tt_commit_group_size",
+     ("histogram", "Number of changes committed by each request's write.")),
+    ("tt_ledger_records", ("gauge", "Number of records in the ledger.")),
+    ("tt_ledger_bytes", ("gauge", "Size of the ledger file, in bytes.")),
+    ("tt_ledger_version", ("gauge", "Version of the ledger.")),
+])
+LATENCY_BUCKETS = [
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+    5.0, 10.0
+]
+GROUP_SIZE_BUCKETS = [1, 2, 4, 8, 16, 32, 64, 128]
+
+# Serializes appends to the performance log from concurrent requests.
+PERF_LOG_LOCK = threading.Lock()
+
+# Number of sorted indexes of the ledger, used to seek to pages of /ls, kept by the server.
+SORT_INDEX_ENTRIES = 8
+
+# Seconds between checks of the ledger for changes to push to /events subscribers, the number of
+# past events kept for subscribers that reconnect, the seconds between keepalive comments on an
+# event stream, and the default and longest time a long-poll request waits for an event.
+EVENTS_POLL_INTERVAL = 0.25
+EVENTS_BACKLOG = 1000
+EVENTS_KEEPALIVE = 15
+EVENTS_DEFAULT_WAIT = 30
+EVENTS_MAX_WAIT = 60
 
 
 class Args(object):
@@ -38,52 +176,557 @@ def __json_type(v, python_type):
         raise ValueError("Value is not of correct type", (v, python_type))
 
 
+class ResponseCache(object):
+    """
+    A bounded LRU cache of rendered response bodies.
+    """
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+class Metrics(object):
+    """
+    The counters and histograms of the server's activity since it started, keyed on metric name and
+    then on the tuple of (label, value) pairs.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = dict()
+        self.histograms = dict()
+
+    def inc(self, name, labels, amount=1):
+        with self.lock:
+            series = self.counters.setdefault(name, dict())
+            series[labels] = series.get(labels, 0) + amount
+
+    def observe(self, name, labels, value, buckets=LATENCY_BUCKETS):
+        with self.lock:
+            series = self.histograms.setdefault(name, dict())
+            if labels not in series:
+                series[labels] = dict(Buckets=buckets,
+                                      Counts=[0] * len(buckets),
+                                      Sum=0.0,
+                                      Count=0)
+            histogram = series[labels]
+            for n, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram["Counts"][n] += 1
+                    break
+            histogram["Sum"] += value
+            histogram["Count"] += 1
+
+    def render(self, gauges):
+        """
+        Render every metric, along with the given gauge values, in the Prometheus text format.
+        """
+        def series_name(name, labels):
+            if labels == ():
+                return name
+            return "%s{%s}" % (name, ",".join(
+                '%s="%s"' % (k, str(v).replace("\\", "\\\\").replace(
+                    '"', '\\"').replace("\n", "\\n")) for k, v in labels))
+
+        lines = list()
+        with self.lock:
+            for name, (metric_type, description) in METRICS.items():
+                lines.append("# HELP %s %s" % (name, description))
+                lines.append("# TYPE %s %s" % (name, metric_type))
+                if metric_type == "gauge" and name in gauges:
+                    lines.append("%s %s" % (name, gauges[name]))
+                for labels, value in sorted(self.counters.get(name, dict()).items()):
+                    lines.append("%s %s" % (series_name(name, labels), value))
+                for labels, histogram in sorted(
+                        self.histograms.get(name, dict()).items()):
+                    cumulative = 0
+                    for bound, count in zip(histogram["Buckets"],
+                                            histogram["Counts"]):
+                        cumulative += count
+                        lines.append("%s %d" % (series_name(
+                            "%s_bucket" % name, labels + (("le", bound), )),
+                                                cumulative))
+                    lines.append("%s %d" % (series_name(
+                        "%s_bucket" % name, labels + (("le", "+Inf"), )),
+                                            histogram["Count"]))
+                    lines.append("%s %r" % (series_name("%s_sum" % name, labels),
+                                            histogram["Sum"]))
+                    lines.append("%s %d" % (series_name("%s_count" % name,
+                                                        labels), histogram["Count"]))
+        return "\n".join(lines) + "\n"
+
+
+class LedgerWatcher(object):
+    """
+    The recent changes to the ledger, numbered in the order they were seen, for /events
+    subscribers to wait on.
+    """
+    def __init__(self, signature, state):
+        self.signature = signature
+        self.state = state
+        self.sequence = 0
+        self.events = deque(maxlen=EVENTS_BACKLOG)
+        self.condition = threading.Condition()
+
+    def publish(self, signature, state, changes):
+        with self.condition:
+            for event_type, data in changes:
+                self.sequence += 1
+                self.events.append(
+                    dict(Id=self.sequence,
+                         Type=event_type,
+                         Version=state.get("Version", 0),
+                         Data=data))
+            self.signature = signature
+            self.state = state
+            self.condition.notify_all()
+
+    def wait(self, since, timeout):
+        """
+        Return the events after the given one, waiting up to the timeout for there to be any. If
+        some of the events since then have been forgotten, or it is from before the server
+        started, a single Resync event is returned instead, telling the subscriber to reload
+        what it needs.
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.sequence != since, timeout)
+            if since > self.sequence or (self.events != deque() and
+                                         since < self.events[0]["Id"] - 1):
+                return [
+                    dict(Id=self.sequence,
+                         Type="Resync",
+                         Version=self.state.get("Version", 0),
+                         Data=None)
+                ]
+            return [event for event in self.events if event["Id"] > since]
+
+
+class LedgerStore(object):
+    """
+    The ledger, whose latest snapshot is shared by every request until it changes, and the queue of
+    changes waiting for the writer thread. A snapshot is never modified once it has been taken:
+    readers use it as it is, and the writer applies each change to a fork of it.
+    """
+    def __init__(self, commit_window, commit_batch):
+        self.lock = threading.Lock()
+        self.ledger = tt.Ledger()
+        self.jobs = queue.Queue()
+        self.writer = None
+        self.commit_window = commit_window
+        self.commit_batch = commit_batch
+
+
+WriteJob = namedtuple("WriteJob",
+                      ["apply", "hooks", "timings", "command", "future", "queued"])
+
+
+class PooledWSGIServer(WSGIServer):
+    """
+    The standard library's WSGI server, handling each connection on one of a fixed pool of threads.
+    """
+    request_queue_size = 128
+
+    def __init__(self, server_address, handler_class, threads):
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+        super().__init__(server_address, handler_class)
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:  # pylint: disable=W0703
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
 class TTServer(Flask):
     def __init__(self, *args, **kwargs):
         if "preshared_key" in kwargs:
             self.psk = kwargs.get("preshared_key")
             del kwargs["preshared_key"]
+        commit_window = kwargs.pop("commit_window", None)
+        commit_batch = kwargs.pop("commit_batch", None)
         super().__init__(*args, **kwargs)
-
-
-def __prepare_context():
-    hooks = tt.load_hooks()
-    tt.run_hooks("pre_load", hooks, None)
-    state, config = tt.__load_state()
-    return hooks, state, config
-
-
-def __finalize(images, hooks, state, config):
-    tt.run_hooks("pre_commit", hooks, images)
-    tt.__write_state(state, hooks)
-    tt.run_hooks("post_commit", hooks, images)
+        self.response_cache = ResponseCache(RESPONSE_CACHE_ENTRIES)
+        self.sort_indexes = ResponseCache(SORT_INDEX_ENTRIES)
+        self.metrics = Metrics()
+        self.store = LedgerStore(
+            COMMIT_WINDOW if commit_window is None else commit_window,
+            COMMIT_BATCH if commit_batch is None else commit_batch)
+        # Started by the first /events subscriber.
+        self.watcher = None
+        self.watcher_lock = threading.Lock()
+        # Bounds the /events subscribers waiting at once, when serving on a fixed pool of threads.
+        self.event_slots = None
+
+
+def __start_request_profiling():
+    g.request_start = time.perf_counter()
+    g.timings = tt.new_timings(request.endpoint)
+    g.profile_modes = set([
+        m.strip().lower()
+        for m in request.headers.get(PROFILE_HEADER, "").split(",")
+        if m.strip() != ""
+    ])
+    g.profiler = None
+    if "stats" in g.profile_modes:
+        import cProfile
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+    if "memory" in g.profile_modes:
+        import tracemalloc
+        tracemalloc.start()
+
+
+def __server_timing(timings):
+    """
+    Render a timing record as a Server-Timing header value, with durations in milliseconds.
+    """
+    metrics = [
+        "%s;dur=%.2f" % (phase, duration * 1000)
+        for phase, duration in timings["Phases"].items()
+    ]
+    metrics += [
+        "hook%d;desc=\"%s/%s\";dur=%.2f" %
+        (n, hook["Event"], hook["Hook"], hook["Duration"] * 1000)
+        for n, hook in enumerate(timings["Hooks"])
+    ]
+    metrics.append("total;dur=%.2f" % (timings["Total"] * 1000))
+    return ", ".join(metrics)
+
+
+def __finish_request_profiling(response):
+    if "timings" not in g:
+        return response
+
+    g.timings["Total"] = time.perf_counter() - g.request_start
+    if g.profiler is not None:
+        g.profiler.disable()
+        profile_dir = os.path.join(tt.dotdir_path(), "profiles")
+        os.makedirs(profile_dir, exist_ok=True)
+        stats_path = os.path.join(
+            profile_dir, "%s-%d.pstats" % (request.endpoint, time.time_ns()))
+        g.profiler.dump_stats(stats_path)
+        response.headers["X-TT-Profile-Stats"] = stats_path
+    if "memory" in g.profile_modes:
+        import tracemalloc
+        g.timings["PeakMemory"] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        response.headers["X-TT-Peak-Memory"] = str(g.timings["PeakMemory"])
+    if g.profile_modes:
+        response.headers["Server-Timing"] = __server_timing(g.timings)
+    __record_metrics(current_app.metrics, g.timings, response.status_code)
+    with PERF_LOG_LOCK:
+        tt.append_perf_record(g.timings, "serve")
+    return response
+
+
+def __record_metrics(metrics, timings, status_code):
+    route = (("route", __command_name()), )
+    metrics.inc("tt_requests_total", route + (("status", status_code), ))
+    metrics.observe("tt_request_duration_seconds", route, timings["Total"])
+    for phase, duration in timings["Phases"].items():
+        metrics.observe("tt_phase_duration_seconds", (("phase", phase), ),
+                        duration)
+    for hook in timings["Hooks"]:
+        labels = (("hook", "%s/%s" % (hook["Event"], hook["Hook"])), )
+        metrics.observe("tt_hook_duration_seconds", labels, hook["Duration"])
+        metrics.inc(
+            "tt_hook_runs_total", labels +
+            (("result", "success" if hook["ReturnCode"] == 0 else "failure"), ))
+    if "GroupSize" in timings:
+        metrics.observe("tt_commit_group_size", (),
+                        timings["GroupSize"],
+                        buckets=GROUP_SIZE_BUCKETS)
+
+
+def metrics():
+    """
+    Report the server's metrics in the Prometheus text exposition format.
+    """
+    _, state, _ = __snapshot(current_app.store)
+    gauges = dict(tt_ledger_records=len(state["Records"]),
+                  tt_ledger_bytes=os.stat(
+                      os.path.join(tt.dotdir_path(), "events.json")).st_size,
+                  tt_ledger_version=state.get("Version", 0))
+    return Response(current_app.metrics.render(gauges),
+                    mimetype="text/plain; version=0.0.4")
+
+
+def __output_format():
+    return request.args.get("output_format", default=API_OUTPUT_FORMAT)
+
+
+def __negotiate_encoding():
+    """
+    Pick the content coding to compress the response with from the request's Accept-Encoding,
+    returning None if it should be sent uncompressed.
+    """
+    best = None
+    for coding in COMPRESSORS:
+        quality = request.accept_encodings[coding]
+        if quality > 0 and (best is None or quality > best[1]):
+            best = (coding, quality)
+    return None if best is None else best[0]
+
+
+def __compress(body, encoding):
+    timings = g.timings if "timings" in g else None
+    with tt.timed_phase(timings, "compress"):
+        return COMPRESSORS[encoding](body)
+
+
+def __compress_response(response):
+    """
+    Compress any response that wasn't compressed from the response cache, if it is big enough to
+    be worth it and the client accepts a compressed response.
+    """
+    if response.is_streamed:
+        return response
+    response.vary.add("Accept-Encoding")
+    if response.status_code in [204, 304] or "Content-Encoding" in response.headers or response.content_length is None or \
+            response.content_length < COMPRESS_MIN_BYTES:
+        return response
+    encoding = __negotiate_encoding()
+    if encoding is not None:
+        response.set_data(__compress(response.get_data(), encoding))
+        response.headers["Content-Encoding"] = encoding
+    return response
+
+
+def __command_name():
+    # The tt command served by the current request, used to select the applicable hooks.
+    return request.endpoint[:-len("_bare")] if request.endpoint.endswith(
+        "_bare") else request.endpoint
+
+
+def __snapshot(store, timings=None):
+    return store.ledger.snapshot(timings)
+
+
+def __prepare_read():
+    __start_request_profiling()
+    with tt.timed_phase(g.timings, "load_hooks"):
+        hooks = tt.load_hooks()
+    tt.run_hooks("pre_load", hooks, None, g.timings, __command_name())
+    signature, state, config = __snapshot(current_app.store, g.timings)
+    g.timings["LedgerRecords"] = len(state["Records"])
+    return signature, state, config
+
+
+def __prepare_write():
+    # The pre_load hooks are run by the writer, once it holds the ledger lock.
+    __start_request_profiling()
+    with tt.timed_phase(g.timings, "load_hooks"):
+        hooks = tt.load_hooks()
+    _, _, config = __snapshot(current_app.store, g.timings)
+    return hooks, config
+
+
+def __run(cmd, pargs, state, config, output):
+    with tt.timed_phase(g.timings, "command"):
+        return cmd(pargs, state, config, output)
+
+
+def __apply_group(store, jobs, timings):
+    """
+    Apply a group of queued changes in order, each to a fork of the state left by the last, and
+    commit every one that succeeded in a single write. Returns, for each job, the exception it
+    failed with, or None and its result.
+    """
+    commands = list(OrderedDict.fromkeys(job.command for job in jobs))
+    outcomes = list()
+    with store.ledger.transaction(timings, jobs[0].hooks, commands) as txn:
+        timings["LedgerRecords"] = len(txn.state["Records"])
+        for job in jobs:
+            try:
+                new_state, images, result = job.apply(txn.fork(), txn.config)
+            except BaseException as exc:  # pylint: disable=W0703
+                outcomes.append((exc, None))
+                continue
+            if new_state is not None:
+                txn.update(job.command, new_state, images)
+            outcomes.append((None, result))
+    timings["BytesWritten"] = txn.written
+    return outcomes
+
+
+def __write_ledger(store):
+    """
+    Apply the queued changes to the ledger in the order they arrived, committing those that arrive
+    within the commit window of each other together, so that a burst of changes costs one durable
+    write and one round of commit hooks. A change is only acknowledged once its write is on disk.
+    """
+    while True:
+        jobs = [store.jobs.get()]
+        deadline = time.perf_counter() + store.commit_window
+        while len(jobs) < store.commit_batch:
+            try:
+                jobs.append(
+                    store.jobs.get(timeout=max(deadline - time.perf_counter(),
+                                               0)))
+            except queue.Empty:
+                break
+
+        started = time.perf_counter()
+        timings = tt.new_timings(None)
+        try:
+            outcomes = __apply_group(store, jobs, timings)
+        except BaseException as exc:  # pylint: disable=W0703
+            outcomes = [(exc, None)] * len(jobs)
+
+        # The work done for the group as a whole is accounted to each change in it.
+        for job, (exc, result) in zip(jobs, outcomes):
+            job.timings["Phases"]["queue_wait"] = started - job.queued
+            for phase, duration in timings["Phases"].items():
+                job.timings["Phases"][phase] = job.timings["Phases"].get(
+                    phase, 0.0) + duration
+            job.timings["Hooks"] += timings["Hooks"]
+            job.timings["LedgerRecords"] = timings.get("LedgerRecords", None)
+            job.timings["BytesWritten"] = timings.get("BytesWritten", 0)
+            job.timings["GroupSize"] = len(jobs)
+            if exc is not None:
+                job.future.set_exception(exc)
+            else:
+                job.future.set_result(result)
+
+
+def __submit(apply, hooks):
+    """
+    Queue a change to the ledger for the writer thread and wait for its result. The apply function
+    is given a fork of the latest state and the config, and returns the state to commit (or None to
+    commit nothing), the images of the change, and the result to return.
+    """
+    store = current_app.store
+    with store.lock:
+        if store.writer is None:
+            store.writer = threading.Thread(target=__write_ledger,
+                                            args=(store, ),
+                                            daemon=True)
+            store.writer.start()
+    future = Future()
+    store.jobs.put(
+        WriteJob(apply, hooks, g.timings, __command_name(), future,
+                 time.perf_counter()))
+    return future.result()
+
+
+def __write(cmd, pargs, hooks):
+    timings = g.timings
+
+    def apply(state, config):
+        output = StringIO()
+        with tt.timed_phase(timings, "command"):
+            images = cmd(pargs, state, config, output)
+        return state, images, output.getvalue()
+
+    return __submit(apply, hooks)
+
+
+def __cached_get(render, pargs, signature, state, config, cacheable=True):
+    """
+    Serve a read-only route, tagging the response with the ledger version it was rendered from. The
+    render function is given the arguments, loaded state, config and snapshot signature, and returns
+    the body and any extra headers of the response.
+
+    Responses are cached, and tagged, on the stat() signature of the snapshot they were rendered
+    from and the request, with the request's timespec filters already resolved to timestamps. The
+    version alone isn't enough, as the ledger can be replaced by something other than tt (such as
+    a git pull) without changing it. A poll of an unchanged ledger is therefore answered without
+    reading it, either with a 304 if the client sent a matching If-None-Match or If-Modified-Since,
+    or with the cached body. A response that isn't cacheable, because it depends on the time as well
+    as the ledger, is rendered afresh for every request, and isn't tagged.
+    """
+    if not cacheable:
+        body, headers = render(pargs, state, config, signature)
+        response = make_response(body, headers)
+        response.headers["X-TT-Ledger-Version"] = str(state.get("Version", 0))
+        return response
+
+    request_key = json.dumps(
+        [request.path, sorted(vars(pargs).items())], sort_keys=True)
+    request_hash = hashlib.sha1(request_key.encode("utf-8")).hexdigest()[:16]
+    snapshot_hash = hashlib.sha1(json.dumps(signature).encode("utf-8")).hexdigest()[:16]
+    version = state.get("Version", 0)
+    # Each content coding is a different representation, so needs its own entity tag.
+    encoding = __negotiate_encoding()
+    etag = "%d-%s-%s" % (version, snapshot_hash, request_hash)
+    if encoding is not None:
+        etag = "%s-%s" % (etag, encoding)
+    rendered = current_app.response_cache.get((signature, request_key))
+    if rendered is None and request.if_none_match.contains(etag):
+        rendered = ("", dict(), dict())
+
+    if rendered is None:
+        body, headers = render(pargs, state, config, signature)
+        # Compressed bodies are cached alongside the rendered one, keyed on the content coding.
+        rendered = (body.encode("utf-8"), headers, dict())
+        current_app.response_cache.put((signature, request_key), rendered)
+
+    body, headers, encoded = rendered
+    if encoding is not None and len(body) >= COMPRESS_MIN_BYTES:
+        if encoding not in encoded:
+            encoded[encoding] = __compress(body, encoding)
+        response = make_response(encoded[encoding], headers)
+        response.headers["Content-Encoding"] = encoding
+    else:
+        response = make_response(body, headers)
+    response.set_etag(etag)
+    response.last_modified = signature[0][2] // 1000000000
+    response.headers["X-TT-Ledger-Version"] = str(version)
+    return response.make_conditional(request)
 
 
 def base():
-    hooks, state, config = __prepare_context()
+    signature, state, config = __prepare_read()
 
     pargs = Args()
-    pargs.output_format = config.get("OutputFormat", None) if request.args.get(
-        "output_format") is None else request.args.get("output_format")
+    pargs.output_format = __output_format()
 
+    # A running stopwatch is shown with the time elapsed so far, which a cached response would freeze.
+    return __cached_get(__render_base,
+                        pargs,
+                        signature,
+                        state,
+                        config,
+                        cacheable=state["Stopwatch"] is None)
+
+
+def __render_base(pargs, state, config, _):
     output = StringIO()
-    tt.cmd_base(pargs, state, config, output)
-    __finalize(None, hooks, state, config)
-    return output.getvalue()
+    __run(tt.cmd_base, pargs, state, config, output)
+    return output.getvalue(), dict()
 
 
 def ls(positional_arg):
-    hooks, state, config = __prepare_context()
+    signature, state, config = __prepare_read()
 
     pargs = Args()
-    pargs.output_format = config.get("OutputFormat", None) if request.args.get(
-        "output_format") is None else request.args.get("output_format")
+    pargs.output_format = __output_format()
     pargs.pos_id = positional_arg
     pargs.sort_by = request.args.get("sort_by", default="StartTime", type=str)
     pargs.last = request.args.get("last", default=None, type=int)
-    pargs.filter = request.args.get("filter",
-                                    default=[],
-                                    type=lambda v: __json_type(v, list))
+    pargs.filter = tt.resolve_filters(
+        request.args.get("filter",
+                         default=[],
+                         type=lambda v: __json_type(v, list)))
     pargs.id = request.args.get("id",
                                 default=[],
                                 type=lambda v: __json_type(v, list))
@@ -93,25 +736,103 @@ def ls(positional_arg):
     pargs.with_structured_data = request.args.get(
         "with_structured_data",
         default=False,
-        type=lambda v: __json_type(v, bool)),
+        type=lambda v: __json_type(v, bool))
     pargs.without_detail = request.args.get(
         "without_detail", default=False, type=lambda v: __json_type(v, bool))
     pargs.dryrun = request.args.get("dryrun",
                                     default=False,
                                     type=lambda v: __json_type(v, bool))
+    pargs.limit = request.args.get("limit", default=None, type=int)
+    pargs.after = request.args.get("after", default=None, type=str)
+    pargs.before = request.args.get("before", default=None, type=str)
+
+    return __cached_get(__render_ls, pargs, signature, state, config)
+
+
+def __render_ls(pargs, state, config, signature):
+    headers = dict()
+    if pargs.limit is not None or pargs.after is not None or pargs.before is not None:
+        # Pages seek into a sorted index of the ledger, which is shared by every page of every
+        # query with the same sort order until the ledger changes.
+        pargs.sort_index = current_app.sort_indexes.get((signature, pargs.sort_by))
+        if pargs.sort_index is None:
+            pargs.sort_index = tt.sort_index(state["Records"], pargs.sort_by)
+            current_app.sort_indexes.put((signature, pargs.sort_by),
+                                         pargs.sort_index)
 
     output = StringIO()
-    tt.cmd_ls(pargs, state, config, output)
-    __finalize(None, hooks, state, config)
-    return output.getvalue()
+    __run(tt.cmd_ls, pargs, state, config, output)
+    for direction, cursor in getattr(pargs, "page_cursors", dict()).items():
+        if cursor is not None:
+            headers["X-TT-%s-Cursor" % direction] = cursor
+    return output.getvalue(), headers
+
+
+def changes():
+    signature, state, config = __prepare_read()
+
+    pargs = Args()
+    pargs.output_format = __output_format()
+    pargs.compact = False
+    pargs.since = request.args.get("since", default=0, type=int)
+    pargs.limit = request.args.get("limit", default=None, type=int)
+
+    return __cached_get(__render_changes, pargs, signature, state, config)
+
+
+def __render_changes(pargs, state, config, _):
+    output = StringIO()
+    __run(tt.cmd_changes, pargs, state, config, output)
+    return output.getvalue(), {
+        "X-TT-Ledger-Sequence": str(state.get("Sequence", 0))
+    }
+
+
+def __authorized():
+    """
+    Check the request's `Authorization: Bearer` key against the server's pre-shared key, if any.
+    """
+    psk = getattr(current_app, "psk", None)
+    if psk is None:
+        return True
+    scheme, _, key = request.headers.get("Authorization", "").partition(" ")
+    return scheme == "Bearer" and hmac.compare_digest(key.encode(),
+                                                      psk.encode())
+
+
+def sync():
+    """
+    Merge the changes pushed by another replica's `tt sync --peer` into the ledger.
+    """
+    if not __authorized():
+        return ("A valid pre-shared key is required to sync.\n", 401, {
+            "WWW-Authenticate": "Bearer"
+        })
+
+    hooks, _ = __prepare_write()
+
+    changes = request.get_json(force=True, silent=True)
+    if not isinstance(changes, list):
+        return ("Request body must be a JSON list of changes.\n", 400)
+
+    timings = g.timings
+
+    def apply(state, config):
+        with tt.timed_phase(timings, "command"):
+            images = tt.apply_changes(state, changes)
+        merged = 0 if images is None else len(images["NewImage"])
+        # A deletion of an item never seen here changes only its tombstone, which is still kept.
+        return state, images, json.dumps(
+            dict(Received=len(changes), Merged=merged), sort_keys=True)
+
+    return __submit(apply, hooks)
 
 
 def sw(positional_arg):
-    hooks, state, config = __prepare_context()
+    hooks, config = __prepare_write()
 
     pargs = Args()
-    pargs.output_format = config.get("OutputFormat", None) if request.args.get(
-        "output_format") is None else request.args.get("output_format")
+    pargs.output_format = __output_format()
     pargs.quicktext = positional_arg if positional_arg is not None else request.args.get(
         "quicktext", default=None)
     pargs.alias = request.args.get("alias", default=None, type=str)
@@ -130,19 +851,14 @@ def sw(positional_arg):
                                    default=[],
                                    type=lambda v: __json_type(v, list))
 
-    output = StringIO()
-    tt.cmd_sw(pargs, state, config, output)
-    __finalize(None, hooks, state, config)
-
-    return output.getvalue()
+    return __write(tt.cmd_sw, pargs, hooks)
 
 
 def start(positional_arg):
-    hooks, state, config = __prepare_context()
+    hooks, config = __prepare_write()
 
     pargs = Args()
-    pargs.output_format = config.get("OutputFormat", None) if request.args.get(
-        "output_format") is None else request.args.get("output_format")
+    pargs.output_format = __output_format()
     pargs.quicktext = positional_arg if positional_arg is not None else request.args.get(
         "quicktext", default=None)
     pargs.alias = request.args.get("alias", default=None, type=str)
@@ -156,19 +872,14 @@ def start(positional_arg):
                                              type=str)
     pargs.start_time = request.args.get("start_time", default=None, type=str)
 
-    output = StringIO()
-    tt.cmd_start(pargs, state, config, output)
-    __finalize(None, hooks, state, config)
-
-    return output.getvalue()
+    return __write(tt.cmd_start, pargs, hooks)
 
 
 def stop(positional_arg):
-    hooks, state, config = __prepare_context()
+    hooks, config = __prepare_write()
 
     pargs = Args()
-    pargs.output_format = config.get("OutputFormat", None) if request.args.get(
-        "output_format") is None else request.args.get("output_format")
+    pargs.output_format = __output_format()
     pargs.quicktext = positional_arg if positional_arg is not None else request.args.get(
         "quicktext", default=None)
     pargs.alias = request.args.get("alias", default=None, type=str)
@@ -186,19 +897,14 @@ def stop(positional_arg):
                                    default=[],
                                    type=lambda v: __json_type(v, list))
 
-    output = StringIO()
-    tt.cmd_stop(pargs, state, config, output)
-    __finalize(None, hooks, state, config)
-
-    return output.getvalue()
+    return __write(tt.cmd_stop, pargs, hooks)
 
 
 def isw(positional_arg):
-    hooks, state, config = __prepare_context()
+    hooks, config = __prepare_write()
 
     pargs = Args()
-    pargs.output_format = config.get("OutputFormat", None) if request.args.get(
-        "output_format") is None else request.args.get("output_format")
+    pargs.output_format = __output_format()
     pargs.quicktext = positional_arg if positional_arg is not None else request.args.get(
         "quicktext", default=None)
     pargs.alias = request.args.get("alias", default=None, type=str)
@@ -215,19 +921,14 @@ def isw(positional_arg):
                                    default=[],
                                    type=lambda v: __json_type(v, list))
 
-    output = StringIO()
-    tt.cmd_isw(pargs, state, config, output)
-    __finalize(None, hooks, state, config)
-
-    return output.getvalue()
+    return __write(tt.cmd_isw, pargs, hooks)
 
 
 def interrupt(positional_arg):
-    hooks, state, config = __prepare_context()
+    hooks, config = __prepare_write()
 
     pargs = Args()
-    pargs.output_format = config.get("OutputFormat", None) if request.args.get(
-        "output_format") is None else request.args.get("output_format")
+    pargs.output_format = __output_format()
     pargs.quicktext = positional_arg if positional_arg is not None else request.args.get(
         "quicktext", default=None)
     pargs.alias = request.args.get("alias", default=None, type=str)
@@ -240,19 +941,14 @@ def interrupt(positional_arg):
                                              default=None,
                                              type=str)
 
-    output = StringIO()
-    tt.cmd_interrupt(pargs, state, config, output)
-    __finalize(None, hooks, state, config)
-
-    return output.getvalue()
+    return __write(tt.cmd_interrupt, pargs, hooks)
 
 
 def resume(positional_arg):
-    hooks, state, config = __prepare_context()
+    hooks, config = __prepare_write()
 
     pargs = Args()
-    pargs.output_format = config.get("OutputFormat", None) if request.args.get(
-        "output_format") is None else request.args.get("output_format")
+    pargs.output_format = __output_format()
     pargs.quicktext = positional_arg if positional_arg is not None else request.args.get(
         "quicktext", default=None)
     pargs.alias = request.args.get("alias", default=None, type=str)
@@ -269,32 +965,23 @@ def resume(positional_arg):
                                    default=[],
                                    type=lambda v: __json_type(v, list))
 
-    output = StringIO()
-    tt.cmd_resume(pargs, state, config, output)
-    __finalize(None, hooks, state, config)
-
-    return output.getvalue()
+    return __write(tt.cmd_resume, pargs, hooks)
 
 
 def cancel(positional_arg):
-    hooks, state, config = __prepare_context()
+    hooks, config = __prepare_write()
 
     pargs = Args()
-    pargs.output_format = config.get("OutputFormat", None) if request.args.get(
-        "output_format") is None else request.args.get("output_format")
+    pargs.output_format = __output_format()
 
-    output = StringIO()
-    tt.cmd_cancel(pargs, state, config, output)
-    __finalize(None, hooks, state, config)
-    return output.getvalue()
+    return __write(tt.cmd_cancel, pargs, hooks)
 
 
 def amend(positional_arg):
-    hooks, state, config = __prepare_context()
+    hooks, config = __prepare_write()
 
     pargs = Args()
-    pargs.output_format = config.get("OutputFormat", None) if request.args.get(
-        "output_format") is None else request.args.get("output_format")
+    pargs.output_format = __output_format()
     pargs.quicktext = positional_arg if positional_arg is not None else request.args.get(
         "quicktext", default=None)
     pargs.alias = request.args.get("alias", default=None, type=str)
@@ -315,19 +1002,23 @@ def amend(positional_arg):
     pargs.dryrun = request.args.get("dryrun",
                                     default=False,
                                     type=lambda v: __json_type(v, bool))
+    pargs.if_version = request.args.get("if_version", default=None, type=int)
+    # If-Match carries the version of the record the client last saw, as the entity tag.
+    if request.if_match and not request.if_match.star_tag:
+        try:
+            (pargs.if_version, ) = [int(v) for v in request.if_match.as_set()]
+        except ValueError:
+            return ("If-Match must be the single version of the record being amended.\n",
+                    400)
 
-    output = StringIO()
-    tt.cmd_amend(pargs, state, config, output)
-    __finalize(None, hooks, state, config)
-    return output.getvalue()
+    return __write(tt.cmd_amend, pargs, hooks)
 
 
 def track(positional_arg):
-    hooks, state, config = __prepare_context()
+    hooks, config = __prepare_write()
 
     pargs = Args()
-    pargs.output_format = config.get("OutputFormat", None) if request.args.get(
-        "output_format") is None else request.args.get("output_format")
+    pargs.output_format = __output_format()
     pargs.quicktext = positional_arg if positional_arg is not None else request.args.get(
         "quicktext", default=None)
     pargs.alias = request.args.get("alias", default=None, type=str)
@@ -349,14 +1040,252 @@ def track(positional_arg):
                                     default=False,
                                     type=lambda v: __json_type(v, bool))
 
-    output = StringIO()
-    tt.cmd_track(pargs, state, config, output)
-    __finalize(None, hooks, state, config)
-    return output.getvalue()
-
+    return __write(tt.cmd_track, pargs, hooks)
+
+
+def __ledger_changes(old, new):
+    """
+    List the stopwatch, interruption and record changes between two states of the ledger, as
+    (event type, data) pairs.
+    """
+    changes = list()
+    for key in ["Stopwatch", "Interruption"]:
+        if old[key] is None and new[key] is not None:
+            changes.append(("%sStarted" % key, new[key]))
+        elif old[key] is not None and new[key] is None:
+            changes.append(("%sStopped" % key, old[key]))
+        elif old[key] != new[key]:
+            changes.append(("%sUpdated" % key, new[key]))
+
+    created = [rid for rid in new["Records"] if rid not in old["Records"]]
+    deleted = [rid for rid in old["Records"] if rid not in new["Records"]]
+    updated = [
+        rid for rid, record in new["Records"].items()
+        if rid in old["Records"] and old["Records"][rid] != record
+    ]
+    if created != [] or updated != [] or deleted != []:
+        changes.append(("RecordsCommitted",
+                        dict(Created=sorted(created),
+                             Updated=sorted(updated),
+                             Deleted=sorted(deleted))))
+    return changes
+
+
+def __watch_ledger(store, watcher):
+    """
+    Check the ledger for changes, whether made by this server or by anything else, and publish them
+    to the /events subscribers. Only a stat() of the ledger is needed while it is unchanged.
+    """
+    while True:
+        time.sleep(EVENTS_POLL_INTERVAL)
+        try:
+            signature, state, _ = __snapshot(store)
+        except (OSError, ValueError):
+            # Unreadable or only partially written, so look again on the next check.
+            continue
+        if signature != watcher.signature:
+            watcher.publish(signature, state,
+                            __ledger_changes(watcher.state, state))
+
+
+def __ledger_watcher():
+    app = current_app._get_current_object()
+    with app.watcher_lock:
+        if app.watcher is None:
+            signature, state, _ = __snapshot(app.store)
+            app.watcher = LedgerWatcher(signature, state)
+            threading.Thread(target=__watch_ledger,
+                             args=(app.store, app.watcher),
+                             daemon=True).start()
+    return app.watcher
+
+
+def events():
+    """
+    Push changes to the stopwatch, interruption and records as they happen. Clients that accept
+    text/event-stream are sent a Server-Sent Events stream, and others are answered as a long poll
+    with the JSON list of events after the one given by the since parameter.
+    """
+    watcher = __ledger_watcher()
+    since = request.args.get("since",
+                             default=request.headers.get("Last-Event-ID", None))
+    try:
+        since = watcher.sequence if since is None else int(since)
+    except ValueError:
+        return ("since and Last-Event-ID must be an event Id.\n", 400)
+
+    # Subscribers hold a thread for as long as they wait, so with a fixed pool of threads only
+    # some of them may wait on events at once, leaving the rest free for other requests.
+    slots = current_app.event_slots
+    if slots is not None and not slots.acquire(blocking=False):
+        if "text/event-stream" in request.accept_mimetypes:
+            return Response("Too many /events subscribers, try again later.\n",
+                            status=503,
+                            headers={"Retry-After": str(EVENTS_KEEPALIVE)})
+        # A long poll is answered at once instead of waiting.
+        pending = watcher.wait(since, 0)
+        return jsonify(Events=pending,
+                       Since=pending[-1]["Id"] if pending != [] else since)
+
+    if "text/event-stream" not in request.accept_mimetypes:
+        wait = min(
+            request.args.get("wait", default=EVENTS_DEFAULT_WAIT, type=float),
+            EVENTS_MAX_WAIT)
+        try:
+            pending = watcher.wait(since, wait)
+        finally:
+            if slots is not None:
+                slots.release()
+        return jsonify(Events=pending,
+                       Since=pending[-1]["Id"] if pending != [] else since)
+
+    def stream(since):
+        while True:
+            pending = watcher.wait(since, EVENTS_KEEPALIVE)
+            if pending == []:
+                yield ": keepalive\n\n"
+            for event in pending:
+                yield "id: %d\nevent: %s\ndata: %s\n\n" % (
+                    event["Id"], event["Type"],
+                    json.dumps(event, sort_keys=True))
+                since = event["Id"]
+
+    response = Response(stream(since),
+                        mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache"})
+    if slots is not None:
+        response.call_on_close(slots.release)
+    return response
+
+
+def __command_error(exc):
+    return ("%s\n" % exc, ERROR_STATUS.get(exc.code, 409), {
+        "X-TT-Exit-Code": str(exc.code)
+    })
+
+
+def __batch_pargs(operation, config):
+    """
+    Build the arguments for one operation of a batch, rejecting unknown commands and arguments, and
+    arguments given values of the wrong type.
+    """
+    if not isinstance(operation, dict) or operation.get(
+            "Command", None) not in BATCH_COMMANDS:
+        raise ValueError("Each operation must be an object with a Command of: %s" %
+                         ", ".join(sorted(BATCH_COMMANDS.keys())))
+    _, accepted_args = BATCH_COMMANDS[operation["Command"]]
+    op_args = operation.get("Args", dict())
+    if not isinstance(op_args, dict):
+        raise ValueError("The Args of an operation must be an object")
+    unknown = set(op_args.keys()).difference(accepted_args)
+    if unknown != set():
+        raise ValueError("Unsupported arguments for %s: %s" %
+                         (operation["Command"], ", ".join(sorted(unknown))))
+
+    for arg, value in op_args.items():
+        # bool is a subclass of int, but isn't a valid number here.
+        valid = (value is None and ARG_DEFAULTS[arg] is None) or (
+            isinstance(value, ARG_TYPES[arg])
+            and not (ARG_TYPES[arg] is int and isinstance(value, bool)))
+        if valid and ARG_TYPES[arg] is list:
+            valid = all(isinstance(item, str) for item in value)
+        if not valid:
+            raise ValueError("Argument %s of %s must be %s" %
+                             (arg, operation["Command"], ARG_TYPE_NAMES[ARG_TYPES[arg]]))
 
-def create_server(preshared_key):
-    app = TTServer("tt", preshared_key=preshared_key)
+    pargs = Args()
+    for arg in accepted_args:
+        setattr(pargs, arg, json.loads(json.dumps(ARG_DEFAULTS[arg])))
+    for arg, value in op_args.items():
+        setattr(pargs, arg, value)
+    if pargs.output_format is None:
+        pargs.output_format = __output_format()
+    return pargs
+
+
+def batch():
+    """
+    Run an ordered list of operations against one loaded state, committing all of them in a single
+    write with one pre_commit/post_commit hook invocation, or none of them if any fails.
+    """
+    hooks, config = __prepare_write()
+
+    body = request.get_json(force=True, silent=True)
+    operations = body.get("Operations", None) if isinstance(body,
+                                                           dict) else body
+    if not isinstance(operations, list):
+        return ("Request body must be a JSON list of operations, or an object with an "
+                "Operations list.\n", 400)
+    try:
+        op_pargs = [__batch_pargs(op, config) for op in operations]
+    except ValueError as exc:
+        return ("%s\n" % exc, 400)
+
+    timings = g.timings
+
+    def apply(working_state, config):
+        # The writer hands over a fork of the state, so a failure leaves nothing behind.
+        results = list()
+        images_list = list()
+        failed = None
+        with tt.timed_phase(timings, "command"):
+            for operation, pargs in zip(operations, op_pargs):
+                if failed is not None:
+                    results.append(
+                        dict(Command=operation["Command"], Status="NotRun"))
+                    continue
+                cmd, _ = BATCH_COMMANDS[operation["Command"]]
+                output = StringIO()
+                try:
+                    images_list.append(cmd(pargs, working_state, config, output))
+                    results.append(
+                        dict(Command=operation["Command"],
+                             Status="Ok",
+                             Output=output.getvalue()))
+                except tt.CommandError as exc:
+                    failed = exc
+                    results.append(
+                        dict(Command=operation["Command"],
+                             Status="Failed",
+                             ExitCode=exc.code,
+                             Error=str(exc),
+                             Output=output.getvalue()))
+        if failed is not None:
+            return None, None, (results, failed)
+        return working_state, tt.merge_images(images_list), (results, None)
+
+    results, failed = __submit(apply, hooks)
+    if failed is not None:
+        return jsonify(Committed=False,
+                       Results=results), ERROR_STATUS.get(failed.code, 409)
+    return jsonify(Committed=True, Results=results)
+
+
+def serve_pooled(app, port, threads):
+    """
+    Serve the app with the standard library's WSGI server, handling requests concurrently on the
+    given number of threads, at most half of which wait on /events at once.
+    """
+    server = PooledWSGIServer(("127.0.0.1", port), WSGIRequestHandler, threads)
+    app.event_slots = threading.BoundedSemaphore(threads // 2)
+    server.set_app(app)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        server.pool.shutdown(wait=False)
+
+
+def create_server(preshared_key, commit_window=None, commit_batch=None):
+    app = TTServer("tt",
+                   preshared_key=preshared_key,
+                   commit_window=None
+                   if commit_window is None else commit_window / 1000.0,
+                   commit_batch=commit_batch)
+    app.after_request(__finish_request_profiling)
+    # Registered after the profiling hook so that it runs first, and the compression is timed.
+    app.after_request(__compress_response)
+    app.register_error_handler(tt.CommandError, __command_error)
 
     app.add_url_rule("/", "base", base, methods=["GET"])
 
@@ -402,6 +1331,22 @@ def create_server(preshared_key):
                      methods=["POST"])
     app.add_url_rule("/track", "track", track, methods=["POST"])
 
-    app.add_url_rule("/amend", "amend", amend, methods=["PATCH"])
+    app.add_url_rule("/amend",
+                     "amend_bare",
+                     lambda: amend(None),
+                     methods=["PATCH"])
+    app.add_url_rule("/amend/<positional_arg>",
+                     "amend",
+                     amend,
+                     methods=["PATCH"])
+
+    app.add_url_rule("/batch", "batch", batch, methods=["POST"])
+
+    app.add_url_rule("/events", "events", events, methods=["GET"])
+
+    app.add_url_rule("/changes", "changes", changes, methods=["GET"])
+    app.add_url_rule("/sync", "sync", sync, methods=["POST"])
+
+    app.add_url_rule("/metrics", "metrics", metrics, methods=["GET"])
 
     return app